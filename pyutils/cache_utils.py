@@ -1,89 +1,2226 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import asyncio
+import hashlib
+import math
+import mmap
+import multiprocessing
 import os
+import pickle
+import sqlite3
+import struct
+import sys
+import threading
+import time
+import types
+import zlib
+import numpy as np
 import ujson
-from typing import Dict, Any, Callable
+from collections import OrderedDict, defaultdict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from functools import partial
+from itertools import repeat
+from json.decoder import scanstring
+from typing import Dict, Any, Callable, Optional, Union, BinaryIO, Iterator, Tuple, Awaitable, List, Set
 
+try:
+    import fcntl
+except ImportError:
+    # advisory file locking is not available (e.g., Windows), concurrent mode of FileCache is disabled
+    fcntl = None
 
-class Cache(object):
+
+def approx_sizeof(obj: Any) -> int:
+    """Approximate number of bytes used by an object, including the items of builtin containers"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(approx_sizeof(x) for x in obj)
+    elif isinstance(obj, dict):
+        size += sum(approx_sizeof(k) + approx_sizeof(v) for k, v in obj.items())
+    return size
+
+
+async def single_flight(inflight: Dict[Any, asyncio.Future], key: Any, compute: Callable[[], Awaitable[Any]]) -> Any:
+    """Run `compute` for a key, unless there is a computation of the same key in progress, in that case, wait for
+    its result instead. The computation isn't cancelled when one of its waiters is cancelled.
+    """
+    future = inflight.get(key)
+    if future is None:
+        future = asyncio.ensure_future(compute())
+        inflight[key] = future
+        future.add_done_callback(lambda _: inflight.pop(key, None))
+    return await asyncio.shield(future)
+
+
+def update_hash(algo: Any, obj: Any) -> None:
+    """Feed a stable encoding of an object to a hash algorithm (e.g., hashlib.blake2b).
+
+    Values are tagged with their types, so that `1`, `1.0`, `True` and `'1'` are different. NumPy arrays are hashed
+    by their dtypes, shapes and raw buffers. Objects can define `__cache_key__` to return a hashable substitute,
+    classes are hashed by their qualified names, functions by their qualified names, code, defaults and closures
+    (see `update_function_hash`), and other objects by their pickle reductions (constructor, arguments and state),
+    so that sets and dicts in their states are ordered as above instead of by the hash seed of the process.
+    """
+    if obj is None:
+        algo.update(b'N')
+    elif isinstance(obj, bool):
+        algo.update(b'T' if obj else b'F')
+    elif isinstance(obj, (int, float)):
+        algo.update(b'%c%s;' % (b'i' if isinstance(obj, int) else b'f', repr(obj).encode('ascii')))
+    elif isinstance(obj, (str, bytes)):
+        if isinstance(obj, str):
+            obj = obj.encode('utf-8')
+            algo.update(b's%d:' % len(obj))
+        else:
+            algo.update(b'b%d:' % len(obj))
+        algo.update(obj)
+    elif isinstance(obj, (tuple, list)):
+        algo.update(b'%c%d:' % (b'(' if isinstance(obj, tuple) else b'[', len(obj)))
+        for x in obj:
+            update_hash(algo, x)
+    elif isinstance(obj, dict):
+        algo.update(b'{%d:' % len(obj))
+        if all(isinstance(k, str) for k in obj):
+            for k in sorted(obj):
+                update_hash(algo, k)
+                update_hash(algo, obj[k])
+        else:
+            # keys can't be compared, order the items by their own hashes instead
+            for digest in sorted(stable_hash(item) for item in obj.items()):
+                algo.update(digest.encode('ascii'))
+    elif isinstance(obj, (set, frozenset)):
+        algo.update(b'{%d}' % len(obj))
+        for digest in sorted(stable_hash(x) for x in obj):
+            algo.update(digest.encode('ascii'))
+    elif isinstance(obj, np.ndarray):
+        algo.update(b'a%s%s' % (obj.dtype.str.encode('ascii'), repr(obj.shape).encode('ascii')))
+        if obj.dtype.hasobject:
+            update_hash(algo, obj.tolist())
+        else:
+            algo.update(np.ascontiguousarray(obj).data)
+    elif isinstance(obj, np.generic):
+        algo.update(b'g%s' % obj.dtype.str.encode('ascii'))
+        algo.update(obj.tobytes())
+    elif hasattr(obj, '__cache_key__'):
+        algo.update(b'k')
+        update_hash(algo, obj.__cache_key__())
+    elif isinstance(obj, types.FunctionType):
+        update_function_hash(algo, obj, set())
+    elif isinstance(obj, types.CodeType):
+        algo.update(b'x')
+        update_hash(algo, (obj.co_code, obj.co_consts, obj.co_names))
+    elif isinstance(obj, (type, types.BuiltinFunctionType)):
+        algo.update(b'c')
+        update_hash(algo, '%s.%s' % (obj.__module__, obj.__qualname__))
+    else:
+        reduction = obj.__reduce_ex__(4)
+        algo.update(b'o')
+        if isinstance(reduction, str):
+            # name of a global object
+            update_hash(algo, reduction)
+        else:
+            # items of lists and dicts are returned as iterators
+            update_hash(algo, tuple(list(x) if isinstance(x, Iterator) else x for x in reduction))
+
+
+def update_function_hash(algo: Any, func: types.FunctionType, visiting: Set[int]) -> None:
+    """Update a hash with a function: its qualified name, its code, its defaults and the contents of its closure, so
+    that closures and lambdas made by the same definition are different if they capture different values.
+
+    :param visiting: ids of the functions being hashed, so that (mutually) recursive closures are hashed by name
+    """
+    algo.update(b'c')
+    update_hash(algo, '%s.%s' % (func.__module__, func.__qualname__))
+    if id(func) in visiting:
+        return
+
+    visiting.add(id(func))
+    update_hash(algo, (func.__code__, func.__defaults__, func.__kwdefaults__))
+    for cell in func.__closure__ or ():
+        try:
+            value = cell.cell_contents
+        except ValueError:
+            # the variable isn't assigned yet
+            algo.update(b'e')
+            continue
+        if isinstance(value, types.FunctionType):
+            update_function_hash(algo, value, visiting)
+        else:
+            update_hash(algo, value)
+    visiting.remove(id(func))
+
+
+def stable_hash(obj: Any) -> str:
+    """Compact hash of an object that is stable across processes (see `update_hash`)"""
+    algo = hashlib.blake2b(digest_size=16)
+    update_hash(algo, obj)
+    return algo.hexdigest()
+
+
+class KeyBuilder(object):
+    """Build keys of function calls. A key is a pair of the function namespace and the key of the arguments"""
+
+    def namespace(self, func: Callable) -> str:
+        raise NotImplementedError()
+
+    def key(self, args: tuple, kwargs: Dict[str, Any]) -> str:
+        raise NotImplementedError()
+
+
+class HashKeyBuilder(KeyBuilder):
+    """Namespace functions by their qualified names, and identify arguments by their stable hashes.
+
+    Arguments that are only short strings or numbers are used as is (their repr), which is cheaper than hashing them.
+    """
+
+    primitive_types = {str, int, float, bool, type(None)}
+
+    def __init__(self, max_raw_length: int=64) -> None:
+        self.max_raw_length = max_raw_length
+
+    def namespace(self, func: Callable) -> str:
+        module = getattr(func, '__module__', None)
+        qualname = getattr(func, '__qualname__', func.__name__)
+        if module is None:
+            return qualname
+        return module + '.' + qualname
+
+    def key(self, args: tuple, kwargs: Dict[str, Any]) -> str:
+        if len(kwargs) == 0:
+            for x in args:
+                if type(x) not in self.primitive_types:
+                    break
+            else:
+                key = repr(args)
+                if len(key) <= self.max_raw_length:
+                    return key
+                return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+        return stable_hash((args, kwargs))
+
+
+class JsonKeyBuilder(KeyBuilder):
+    """Namespace functions by their names and identify arguments by their JSON encodings.
+
+    This is how keys were built before HashKeyBuilder, use it to keep reading files of FileCache that are written
+    by previous versions.
+    """
+
+    def namespace(self, func: Callable) -> str:
+        return func.__name__
+
+    def key(self, args: tuple, kwargs: Dict[str, Any]) -> str:
+        if len(kwargs) == 0:
+            return ujson.dumps(args)
+        return ujson.dumps((args, kwargs), sort_keys=True)
+
+
+class EvictionPolicy(object):
+    """Keep track of the keys of one function namespace and pick the key to evict when the namespace is full.
+
+    Every operation must be O(1) because it is executed on every cache hit.
+    """
+
+    def add(self, key: str) -> None:
+        raise NotImplementedError()
+
+    def touch(self, key: str) -> None:
+        raise NotImplementedError()
+
+    def remove(self, key: str) -> None:
+        raise NotImplementedError()
+
+    def victim(self) -> str:
+        raise NotImplementedError()
+
+
+class LRUPolicy(EvictionPolicy):
+    """Evict the least recently used key"""
 
     def __init__(self) -> None:
-        self.data = {}
+        self.keys = OrderedDict()  # type: OrderedDict[str, None]
+
+    def add(self, key: str) -> None:
+        self.keys[key] = None
+
+    def touch(self, key: str) -> None:
+        self.keys.move_to_end(key)
+
+    def remove(self, key: str) -> None:
+        del self.keys[key]
+
+    def victim(self) -> str:
+        return next(iter(self.keys))
+
+
+class LFUPolicy(EvictionPolicy):
+    """Evict the least frequently used key, ties are broken by evicting the least recently used one.
+
+    Keys are grouped into buckets by their frequencies, so that increasing a frequency is O(1).
+    """
+
+    def __init__(self) -> None:
+        self.freqs = {}  # type: Dict[str, int]
+        self.buckets = {}  # type: Dict[int, OrderedDict[str, None]]
+        self.min_freq = 0
+
+    def add(self, key: str) -> None:
+        self.freqs[key] = 1
+        self.buckets.setdefault(1, OrderedDict())[key] = None
+        self.min_freq = 1
+
+    def touch(self, key: str) -> None:
+        freq = self.freqs[key]
+        self.__unlink(key, freq)
+        if self.min_freq == freq and freq not in self.buckets:
+            self.min_freq = freq + 1
+        self.freqs[key] = freq + 1
+        self.buckets.setdefault(freq + 1, OrderedDict())[key] = None
+
+    def remove(self, key: str) -> None:
+        self.__unlink(key, self.freqs.pop(key))
+
+    def victim(self) -> str:
+        if self.min_freq not in self.buckets:
+            # the min bucket is only gone after explicit removals, which are rare
+            self.min_freq = min(self.buckets)
+        return next(iter(self.buckets[self.min_freq]))
+
+    def __unlink(self, key: str, freq: int) -> None:
+        bucket = self.buckets[freq]
+        del bucket[key]
+        if len(bucket) == 0:
+            del self.buckets[freq]
+
+
+EVICTION_POLICIES = {
+    'lru': LRUPolicy,
+    'lfu': LFUPolicy,
+}  # type: Dict[str, Callable[[], EvictionPolicy]]
+
+
+class CacheStats(object):
+    """Counters of a function namespace of a cache, times are in seconds"""
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # time spent computing the misses
+        self.compute_time = 0.0
+        # time spent building the keys
+        self.key_time = 0.0
+        self.bytes_written = 0
+
+    def update(self, other: 'CacheStats') -> None:
+        """Add the counters of another CacheStats"""
+        self.hits += other.hits
+        self.misses += other.misses
+        self.evictions += other.evictions
+        self.compute_time += other.compute_time
+        self.key_time += other.key_time
+        self.bytes_written += other.bytes_written
+
+    def to_dict(self) -> Dict[str, Union[int, float]]:
+        """Snapshot of the counters. The saved time is estimated by the average time of computing a miss"""
+        n_calls = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / n_calls if n_calls > 0 else 0.0,
+            'evictions': self.evictions,
+            'compute_time': self.compute_time,
+            'saved_time': self.hits * self.compute_time / self.misses if self.misses > 0 else 0.0,
+            'key_time': self.key_time,
+            'bytes_written': self.bytes_written,
+        }
+
+
+class BaseCache(object):
+    """Parts shared by the caches: keys of the function calls, time-to-live of the entries and counters of each
+    function namespace"""
+
+    # keys of the entries contain their namespaces (`<namespace>:<key>`), as the entries of every function are
+    # stored together (e.g., in one log)
+    namespaced_keys = True
+
+    def __init__(self, key_builder: Optional[KeyBuilder], ttl: Optional[float]) -> None:
+        """
+        :param key_builder: build keys of function calls, default is HashKeyBuilder
+        :param ttl: default time-to-live (seconds) of entries, never expire if None
+        """
+        self.key_builder = key_builder if key_builder is not None else HashKeyBuilder()
+        self.ttl = ttl
+        self.ttls = {}  # type: Dict[str, Optional[float]]
+        self.counters = defaultdict(CacheStats)  # type: Dict[str, CacheStats]
+
+    def stats(self) -> Dict[str, Dict[str, Union[int, float]]]:
+        """Snapshot of the counters of each function namespace"""
+        return {namespace: counters.to_dict() for namespace, counters in self.counters.items()}
+
+    def reset_stats(self) -> None:
+        self.counters = defaultdict(CacheStats)
+
+    def set_ttl(self, func: Callable[..., Any], ttl: Optional[float]) -> None:
+        """Set time-to-live (seconds) of entries of a function, None means its entries never expire"""
+        self.ttls[self.key_builder.namespace(func)] = ttl
+
+    def get_key(self, func: Callable[..., Any], args: tuple, kwargs: Dict[str, Any]) -> str:
+        """Key of a function call, as given to `exec_keyed_func`"""
+        key = self.key_builder.key(args, kwargs)
+        if self.namespaced_keys:
+            return '%s:%s' % (self.key_builder.namespace(func), key)
+        return key
+
+    def _build_key(self, func: Callable[..., Any], args: tuple, kwargs: Dict[str, Any]) -> Tuple[str, str]:
+        """Namespace and key of a function call, the time spent is added to the counters of the namespace"""
+        start = time.perf_counter()
+        namespace = self.key_builder.namespace(func)
+        key = self.key_builder.key(args, kwargs)
+        if self.namespaced_keys:
+            key = '%s:%s' % (namespace, key)
+        self.counters[namespace].key_time += time.perf_counter() - start
+        return namespace, key
+
+    def _build_keys(self, func: Callable[..., Any], args_list: List[tuple]) -> Tuple[str, List[str]]:
+        """Same as `_build_key` for the positional arguments of several calls"""
+        start = time.perf_counter()
+        namespace = self.key_builder.namespace(func)
+        keys = [self.key_builder.key(args, {}) for args in args_list]
+        if self.namespaced_keys:
+            keys = ['%s:%s' % (namespace, key) for key in keys]
+        self.counters[namespace].key_time += time.perf_counter() - start
+        return namespace, keys
+
+    def _is_expired(self, namespace: str, timestamp: Optional[float]) -> bool:
+        """Test if an entry written at `timestamp` (None if unknown) is expired"""
+        ttl = self.ttls.get(namespace, self.ttl)
+        return ttl is not None and (timestamp is None or time.time() - timestamp > ttl)
+
+    def _add_hot(self, key: str, record: Tuple[Any, Optional[float]]) -> None:
+        """Keep a record (value, timestamp) in the `hot_size` most recently used records (`hot`), for the caches
+        that read their values from their storage on demand"""
+        if self.hot_size <= 0:
+            return
+        self.hot[key] = record
+        self.hot.move_to_end(key)
+        if len(self.hot) > self.hot_size:
+            self.hot.popitem(last=False)
+
+
+class Cache(BaseCache):
+    """Cache results of functions in memory"""
+
+    # entries are stored per namespace
+    namespaced_keys = False
+
+    def __init__(self,
+                 max_size: Optional[int]=None,
+                 max_bytes: Optional[int]=None,
+                 eviction: Union[str, Callable[[], EvictionPolicy]]='lru',
+                 sizeof: Callable[[Any], int]=approx_sizeof,
+                 key_builder: Optional[KeyBuilder]=None,
+                 ttl: Optional[float]=None,
+                 stale_while_revalidate: bool=False) -> None:
+        """
+        :param max_size: maximum number of entries of each function, unbounded if None
+        :param max_bytes: approximate memory budget (measured by `sizeof`) of each function, unbounded if None
+        :param eviction: name of the eviction policy ('lru' or 'lfu') or a constructor of an EvictionPolicy
+        :param sizeof: function to estimate the size of a cached value
+        :param key_builder: build keys of function calls, default is HashKeyBuilder
+        :param ttl: default time-to-live (seconds) of entries, never expire if None. Use `set_ttl` to set the ttl of
+            a function
+        :param stale_while_revalidate: return an expired value immediately and refresh it in a background thread
+            instead of recomputing it in the caller
+        """
+        super().__init__(key_builder, ttl)
+        self.data = {}  # type: Dict[str, Dict[str, Any]]
+        self.timestamps = {}  # type: Dict[str, Dict[str, Optional[float]]]
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.eviction = EVICTION_POLICIES[eviction] if isinstance(eviction, str) else eviction
+        self.sizeof = sizeof
+        self.bounded = max_size is not None or max_bytes is not None
+
+        # only used when the cache is bounded
+        self.policies = {}  # type: Dict[str, EvictionPolicy]
+        self.sizes = {}  # type: Dict[str, Dict[str, int]]
+        self.nbytes = {}  # type: Dict[str, int]
+
+        self.stale_while_revalidate = stale_while_revalidate
+        # entries are only modified from other threads when refreshing stale values
+        self.lock = threading.RLock() if stale_while_revalidate else nullcontext()
+        self.refreshing = set()  # type: Set[Tuple[str, str]]
+        self.executor = None  # type: Optional[ThreadPoolExecutor]
+
+        # computations of async_exec_func that are in progress
+        self.inflight = {}  # type: Dict[Tuple[str, str], asyncio.Future]
+
+    def exec_func(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        namespace, key = self._build_key(func, args, kwargs)
+        return self.exec_keyed_func(namespace, key, func, args, kwargs)
+
+    def exec_keyed_func(self, namespace: str, key: str, func: Callable[..., Any], args: tuple,
+                        kwargs: Dict[str, Any], timestamped: bool=False) -> Any:
+        """Same as `exec_func` but with the namespace and key that are already computed.
 
-    def exec_func(self, func: Callable[[Any], Any], *args: Any) -> Any:
-        key = ujson.dumps(args)
-        if func.__name__ not in self.data:
-            self.data[func.__name__] = {}
+        :param timestamped: func returns the value and the time it was computed (e.g., read from another cache),
+            which the ttl of the entry is counted from
+        """
+        counters = self.counters[namespace]
+        with self.lock:
+            data = self.__get_namespace(namespace)
+            if key in data:
+                if self.bounded:
+                    self.policies[namespace].touch(key)
+                value = data[key]
+                if not self._is_expired(namespace, self.timestamps[namespace][key]):
+                    counters.hits += 1
+                    return value
+                if self.stale_while_revalidate:
+                    counters.hits += 1
+                    self.__refresh(namespace, key, func, args, kwargs, timestamped)
+                    return value
 
-        if key not in self.data[func.__name__]:
-            self.data[func.__name__][key] = func(*args)
-        return self.data[func.__name__][key]
+        value, timestamp = self.__split_timestamp(self.__compute(counters, func, args, kwargs), timestamped)
+        self.__put(namespace, key, value, timestamp)
+        return value
 
-    def clear_func(self, func: Callable[[Any], Any]):
-        del self.data[func.__name__]
+    async def async_exec_func(self, func: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        """Same as `exec_func` but for coroutine functions. Concurrent calls that miss the same key share
+        one computation"""
+        namespace, key = self._build_key(func, args, kwargs)
+        return await self.async_exec_keyed_func(namespace, key, func, args, kwargs)
 
+    async def async_exec_keyed_func(self, namespace: str, key: str, func: Callable[..., Awaitable[Any]],
+                                    args: tuple, kwargs: Dict[str, Any], timestamped: bool=False) -> Any:
+        """Same as `async_exec_func` but with the namespace and key that are already computed (see
+        `exec_keyed_func` for `timestamped`)"""
+        counters = self.counters[namespace]
 
-class FileCache(object):
+        async def compute():
+            start = time.perf_counter()
+            value = await func(*args, **kwargs)
+            counters.compute_time += time.perf_counter() - start
+            counters.misses += 1
+            value, timestamp = self.__split_timestamp(value, timestamped)
+            self.__put(namespace, key, value, timestamp)
+            return value
 
-    def __init__(self, fpath: str) -> None:
+        with self.lock:
+            data = self.__get_namespace(namespace)
+            if key in data:
+                if self.bounded:
+                    self.policies[namespace].touch(key)
+                value = data[key]
+                if not self._is_expired(namespace, self.timestamps[namespace][key]):
+                    counters.hits += 1
+                    return value
+                if self.stale_while_revalidate:
+                    counters.hits += 1
+                    # refresh in a task of the event loop, sharing the computation with other callers
+                    asyncio.ensure_future(single_flight(self.inflight, (namespace, key), compute))
+                    return value
+
+        return await single_flight(self.inflight, (namespace, key), compute)
+
+    def clear(self) -> None:
+        """Remove the entries of every function"""
+        with self.lock:
+            for namespace in list(self.data.keys()):
+                self.__clear_namespace(namespace)
+
+    def clear_func(self, func: Callable[..., Any]):
+        with self.lock:
+            self.__clear_namespace(self.key_builder.namespace(func))
+
+    def __clear_namespace(self, namespace: str) -> None:
+        del self.data[namespace]
+        del self.timestamps[namespace]
+        if self.bounded:
+            del self.policies[namespace]
+            del self.sizes[namespace]
+            del self.nbytes[namespace]
+
+    def __refresh(self, namespace: str, key: str, func: Callable[..., Any], args: tuple, kwargs: Dict[str, Any],
+                  timestamped: bool):
+        """Recompute an entry in the background thread, unless it's being refreshed"""
+        if (namespace, key) in self.refreshing:
+            return
+        self.refreshing.add((namespace, key))
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1)
+
+        def refresh():
+            try:
+                value = self.__compute(self.counters[namespace], func, args, kwargs)
+                self.__put(namespace, key, *self.__split_timestamp(value, timestamped))
+            finally:
+                with self.lock:
+                    self.refreshing.discard((namespace, key))
+
+        self.executor.submit(refresh)
+
+    def __compute(self, counters: CacheStats, func: Callable[..., Any], args: tuple, kwargs: Dict[str, Any]) -> Any:
+        start = time.perf_counter()
+        value = func(*args, **kwargs)
+        counters.compute_time += time.perf_counter() - start
+        counters.misses += 1
+        return value
+
+    def __get_namespace(self, namespace: str) -> Dict[str, Any]:
+        if namespace not in self.data:
+            self.data[namespace] = {}
+            self.timestamps[namespace] = {}
+            if self.bounded:
+                self.policies[namespace] = self.eviction()
+                self.sizes[namespace] = {}
+                self.nbytes[namespace] = 0
+        return self.data[namespace]
+
+    @staticmethod
+    def __split_timestamp(result: Any, timestamped: bool) -> Tuple[Any, Optional[float]]:
+        """Value and timestamp of the result of a cached function"""
+        if timestamped:
+            return result
+        return result, time.time()
+
+    def __put(self, namespace: str, key: str, value: Any, timestamp: Optional[float]) -> None:
+        """Store an entry computed at `timestamp` (None if unknown, it's then expired if the ttl is set)"""
+        with self.lock:
+            data = self.__get_namespace(namespace)
+            if self.bounded and key in data:
+                # replace an expired value
+                self.__remove(namespace, key)
+            data[key] = value
+            self.timestamps[namespace][key] = timestamp
+            if self.bounded:
+                self.__add_entry(namespace, key, value)
+
+    def __add_entry(self, namespace: str, key: str, value: Any) -> None:
+        """Track a new entry of a namespace and evict old entries if the namespace is over its budget"""
+        data = self.data[namespace]
+        policy = self.policies[namespace]
+        policy.add(key)
+        if self.max_bytes is not None:
+            size = self.sizeof(value)
+            self.sizes[namespace][key] = size
+            self.nbytes[namespace] += size
+
+        while len(data) > 0 and (
+                (self.max_size is not None and len(data) > self.max_size) or
+                (self.max_bytes is not None and self.nbytes[namespace] > self.max_bytes)):
+            self.__remove(namespace, policy.victim())
+            self.counters[namespace].evictions += 1
+
+    def __remove(self, namespace: str, key: str) -> None:
+        del self.data[namespace][key]
+        del self.timestamps[namespace][key]
+        self.policies[namespace].remove(key)
+        if self.max_bytes is not None:
+            self.nbytes[namespace] -= self.sizes[namespace].pop(key)
+
+
+class RecordCodec(object):
+    """Encode records (key, value, timestamp) of FileCache and frame them in the log file"""
+
+    def encode(self, key: str, value: Any, timestamp: Optional[float]) -> bytes:
+        raise NotImplementedError()
+
+    def decode(self, buffer: Union[bytes, mmap.mmap], offset: int) -> Tuple[str, Any, Optional[float]]:
+        """Decode the record starting at the offset of a buffer"""
+        raise NotImplementedError()
+
+    def read(self, f: BinaryIO) -> Optional[bytes]:
+        """Read the record at the current position of the file, return None if there is no complete record"""
+        raise NotImplementedError()
+
+    def scan(self, f: BinaryIO, offset: int) -> Iterator[Tuple[int, int, str]]:
+        """Iterate over complete records from the offset, yield (offset, length, key) without decoding values"""
+        raise NotImplementedError()
+
+
+class JsonCodec(RecordCodec):
+    """One JSON array `[key, value, timestamp]` per line. Records written by previous versions don't have
+    timestamps"""
+
+    def encode(self, key: str, value: Any, timestamp: Optional[float]) -> bytes:
+        return (ujson.dumps((key, value, timestamp)) + '\n').encode('utf-8')
+
+    def decode(self, buffer: Union[bytes, mmap.mmap], offset: int) -> Tuple[str, Any, Optional[float]]:
+        record = ujson.loads(buffer[offset:buffer.find(b'\n', offset)])
+        return record[0], record[1], record[2] if len(record) > 2 else None
+
+    def read(self, f: BinaryIO) -> Optional[bytes]:
+        line = f.readline()
+        if not line.endswith(b'\n'):
+            # end of file or partially written record
+            return None
+        return line
+
+    def scan(self, f: BinaryIO, offset: int) -> Iterator[Tuple[int, int, str]]:
+        f.seek(offset)
+        for line in f:
+            if not line.endswith(b'\n'):
+                break
+            # read the key without decoding the value
+            yield offset, len(line), scanstring(line.decode('utf-8'), 2)[0]
+            offset += len(line)
+
+
+class BinaryCodec(RecordCodec):
+    """Length-prefixed binary records, values are pickled so that types (e.g., tuples) are preserved.
+
+    With `out_of_band`, buffers of NumPy arrays are stored raw (16-byte aligned) next to the pickled value instead of
+    inside it, so that they are neither parsed nor copied when a record is decoded from a memory-mapped log: the
+    arrays are read-only views of the log.
+
+    Layout: header (magic, record length, key length, pickle length, number of buffers, timestamp), lengths of
+    buffers, key, pickled value, buffers; the record is padded to a multiple of 16 bytes.
+    """
+
+    magic = b'PYUC'
+    header = struct.Struct('<4sQIIId')
+    alignment = 16
+
+    def __init__(self, out_of_band: bool=True) -> None:
+        self.out_of_band = out_of_band
+
+    def encode(self, key: str, value: Any, timestamp: Optional[float]) -> bytes:
+        buffers = []
+        if self.out_of_band:
+            payload = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+            buffers = [buffer.raw() for buffer in buffers]
+        else:
+            payload = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        bkey = key.encode('utf-8')
+
+        record = bytearray(self.header.size)
+        record += struct.pack('<%dQ' % len(buffers), *[buffer.nbytes for buffer in buffers])
+        record += bkey
+        record += payload
+        for buffer in buffers:
+            record += bytes(self.__padding(len(record)))
+            record += buffer
+        record += bytes(self.__padding(len(record)))
+        self.header.pack_into(record, 0, self.magic, len(record), len(bkey), len(payload), len(buffers),
+                              float('nan') if timestamp is None else timestamp)
+        return bytes(record)
+
+    def decode(self, buffer: Union[bytes, mmap.mmap], offset: int) -> Tuple[str, Any, Optional[float]]:
+        magic, length, key_length, payload_length, n_buffers, timestamp = self.header.unpack_from(buffer, offset)
+        assert magic == self.magic, 'Invalid record at offset %d' % offset
+        pos = offset + self.header.size
+        buffer_lengths = struct.unpack_from('<%dQ' % n_buffers, buffer, pos)
+        pos += 8 * n_buffers
+        key = bytes(buffer[pos:pos + key_length]).decode('utf-8')
+        pos += key_length
+        payload = buffer[pos:pos + payload_length]
+        pos += payload_length
+
+        view = memoryview(buffer)
+        buffers = []
+        for buffer_length in buffer_lengths:
+            pos += self.__padding(pos - offset)
+            buffers.append(view[pos:pos + buffer_length])
+            pos += buffer_length
+        value = pickle.loads(payload, buffers=buffers)
+        return key, value, None if math.isnan(timestamp) else timestamp
+
+    def read(self, f: BinaryIO) -> Optional[bytes]:
+        header = f.read(self.header.size)
+        if len(header) < self.header.size:
+            return None
+        length = self.header.unpack(header)[1]
+        body = f.read(length - self.header.size)
+        if len(body) < length - self.header.size:
+            return None
+        return header + body
+
+    def scan(self, f: BinaryIO, offset: int) -> Iterator[Tuple[int, int, str]]:
+        size = os.fstat(f.fileno()).st_size
+        while offset + self.header.size <= size:
+            f.seek(offset)
+            magic, length, key_length, payload_length, n_buffers, timestamp = self.header.unpack(
+                f.read(self.header.size))
+            assert magic == self.magic, 'Invalid record at offset %d' % offset
+            if offset + length > size:
+                break
+            f.seek(offset + self.header.size + 8 * n_buffers)
+            yield offset, length, f.read(key_length).decode('utf-8')
+            offset += length
+
+    def __padding(self, length: int) -> int:
+        return -length % self.alignment
+
+
+def get_index_fpath(fpath: str) -> str:
+    return fpath + '.idx'
+
+
+def read_index(fpath: str) -> Tuple[Dict[str, int], int]:
+    """Read the sidecar index of a log file, return the offsets of keys and the size of the log file covered by the index.
+
+    Records that are appended after the index was written are not covered, and an index of another log file (the
+    log has been replaced since the index was written) or that covers more than the log file (e.g., the log has
+    been truncated) is ignored.
+    """
+    index_fpath = get_index_fpath(fpath)
+    if not os.path.exists(index_fpath) or not os.path.exists(fpath):
+        return {}, 0
+
+    with open(index_fpath, 'r') as f:
+        index = ujson.load(f)
+    stat = os.stat(fpath)
+    if index.get('inode', None) != stat.st_ino or index['size'] > stat.st_size:
+        return {}, 0
+    return index['offsets'], index['size']
+
+
+def write_index(fpath: str, offsets: Dict[str, int], size: int, inode: int) -> None:
+    """Write the sidecar index of a log file: offsets of keys in the first `size` bytes of the log, whose inode is
+    `inode`"""
+    index_fpath = get_index_fpath(fpath)
+    with open(index_fpath + '.tmp', 'w') as f:
+        ujson.dump({'size': size, 'inode': inode, 'offsets': offsets}, f)
+    os.replace(index_fpath + '.tmp', index_fpath)
+
+
+def compact_file(fpath: str, codec: Optional[RecordCodec]=None) -> Dict[str, int]:
+    """Rewrite a log file of FileCache so that it contains only the latest record of each key, and update its index.
+
+    Records are copied as raw bytes so their values are not decoded. Return the new offsets of the keys.
+    """
+    codec = codec if codec is not None else JsonCodec()
+    records = {}  # type: Dict[str, Tuple[int, int]]
+    with open(fpath, 'rb') as f:
+        for offset, length, key in codec.scan(f, 0):
+            records[key] = (offset, length)
+
+        offsets = {}
+        with open(fpath + '.tmp', 'wb') as g:
+            for key, (offset, length) in sorted(records.items(), key=lambda x: x[1][0]):
+                f.seek(offset)
+                offsets[key] = g.tell()
+                g.write(f.read(length))
+            g.flush()
+            os.fsync(g.fileno())
+            size = g.tell()
+
+    os.replace(fpath + '.tmp', fpath)
+    write_index(fpath, offsets, size, os.stat(fpath).st_ino)
+    return offsets
+
+
+def detect_key_builder(fpath: str, codec: Optional[RecordCodec]=None) -> KeyBuilder:
+    """Key builder of the records of a log file of FileCache: JsonKeyBuilder if its keys are built by previous
+    versions (arguments encoded as JSON arrays), otherwise HashKeyBuilder (e.g., the file doesn't exist)"""
+    codec = codec if codec is not None else JsonCodec()
+    try:
+        with open(fpath, 'rb') as f:
+            for offset, length, key in codec.scan(f, 0):
+                # keys of HashKeyBuilder are tuple reprs or hex digests
+                if key.partition(':')[2].startswith('['):
+                    return JsonKeyBuilder()
+                break
+    except FileNotFoundError:
+        pass
+    return HashKeyBuilder()
+
+
+class FileCache(BaseCache):
+    """Cache results of functions in memory and persist them to an append-only log file. Records are encoded by
+    a RecordCodec: one JSON record per line (default), or binary records (BinaryCodec) for values that aren't JSON
+    or that contain large arrays.
+
+    The byte offset of the latest record of each key is kept in a sidecar index (`<fpath>.idx`) so that the log
+    can be reloaded without scanning superseded records, and the log can be compacted with `compact`.
+
+    In lazy mode, only keys and offsets are loaded; values are decoded on demand from the memory-mapped log
+    and the most recently used `hot_size` values are kept in memory.
+
+    In concurrent mode, several processes can share the same log: records are appended atomically under an
+    advisory lock (`<fpath>.lock`), and records written by other processes are read from the tail of the log
+    before computing a missing value.
+
+    Records are written to the log as soon as they are computed, unless `flush_every` (number of records) or
+    `flush_interval` (milliseconds) is set: records are then buffered and written in one call (group commit)
+    when one of the limits is reached, when `flush` is called, or when exiting the context. If `fsync` is True,
+    the log is also fsync-ed every time it's flushed.
+
+    Records store the time they are written, entries expire lazily (when they are read) after their time-to-live
+    (`ttl`, or set per function with `set_ttl`). With `stale_while_revalidate`, expired values are returned
+    immediately and refreshed in a background thread.
+
+    The log can be loaded in a background thread (`load_data(background=True)`) while the cache is already used:
+    a lookup of a key that is in the index waits until the loader has read the key's record, other keys are
+    computed (or wait for the end of the loading if `wait_on_miss` is True). Values computed during the loading
+    take precedence over the records read afterward.
+
+    Keys are built by HashKeyBuilder, except for logs written by previous versions, whose keys are built by
+    JsonKeyBuilder (see `detect_key_builder`): they keep being read and extended with the same keys. To migrate
+    such a log to HashKeyBuilder, delete it or pass `key_builder` explicitly (its old records are then missed).
+    """
+
+    def __init__(self,
+                 fpath: str,
+                 lazy: bool=False,
+                 hot_size: int=0,
+                 concurrent: bool=False,
+                 flush_every: Optional[int]=None,
+                 flush_interval: Optional[float]=None,
+                 fsync: bool=False,
+                 key_builder: Optional[KeyBuilder]=None,
+                 ttl: Optional[float]=None,
+                 stale_while_revalidate: bool=False,
+                 codec: Optional[RecordCodec]=None) -> None:
+        assert not concurrent or fcntl is not None, 'Concurrent mode requires fcntl (POSIX)'
         self.fpath = fpath
+        self.codec = codec if codec is not None else JsonCodec()
+        self.lazy = lazy
+        self.hot_size = hot_size
+        self.concurrent = concurrent
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        super().__init__(key_builder if key_builder is not None else detect_key_builder(fpath, self.codec), ttl)
         self.data = {}  # type: Dict[str, Any]
+        # write time of the values in data, None for records written by previous versions
+        self.timestamps = {}  # type: Dict[str, Optional[float]]
+        # key => (value, timestamp)
+        self.hot = OrderedDict()  # type: OrderedDict[str, Tuple[Any, Optional[float]]]
+        self.offsets = {}  # type: Dict[str, int]
+        # offsets are only complete (can be saved to the index) when they cover every record of the log up to
+        # the tail (see below)
+        self.offsets_complete = not os.path.exists(fpath)
+        self.mmap = None  # type: Optional[mmap.mmap]
         self.fcursor = None  # type: Any
         self.within_context = False
+        # computations of async_exec_func that are in progress
+        self.inflight = {}  # type: Dict[str, asyncio.Future]
 
-    def load_data(self) -> None:
-        # Load data if the file's existed
+        # records waiting for the group commit: key => (value, timestamp, encoded record)
+        self.pending = OrderedDict()  # type: OrderedDict[str, Tuple[Any, float, bytes]]
+        self.flush_timer = None  # type: Optional[threading.Timer]
+        self.lock = threading.RLock()
+
+        self.stale_while_revalidate = stale_while_revalidate
+        self.refreshing = set()  # type: Set[str]
+        self.executor = None  # type: Optional[ThreadPoolExecutor]
+
+        # end of the records of the log that have been read or written, and the inode of the log, for following
+        # records appended by other processes
+        self.tail = 0 if self.offsets_complete else None  # type: Optional[int]
+        self.inode = None  # type: Optional[int]
+        # tail when entering the context
+        self.context_tail = None  # type: Optional[int]
+        self.freader = None  # type: Optional[BinaryIO]
+        self.flock = None  # type: Optional[BinaryIO]
+
+        # background loading: the loader notifies the lookups that wait for a key each time it reads a record
+        self.loading = False
+        self.loader = None  # type: Optional[threading.Thread]
+        self.loader_error = None  # type: Optional[BaseException]
+        self.loaded = threading.Condition(self.lock)
+        # offsets of the index being loaded (None until the index is read) and the offset the loader has reached
+        self.loading_offsets = None  # type: Optional[Dict[str, int]]
+        self.loading_progress = 0
+        self.wait_on_miss = False
+        # keys written while loading, their records read by the loader are outdated
+        self.written = set()  # type: Set[str]
+
+    def load_data(self, background: bool=False, wait_on_miss: bool=False) -> None:
+        """Load the log if the file exists.
+
+        :param background: load the log in a background thread, the cache can be used before the loading is done
+        :param wait_on_miss: (background loading) wait for the end of the loading on a lookup of a key that isn't
+            in the index, instead of computing it
+        """
         assert not self.within_context, 'Must load the data before caching'
-        if os.path.exists(self.fpath):
-            with open(self.fpath, 'r') as f:
-                for l in f:
-                    k, v = ujson.loads(l)
-                    self.data[k] = v
+        assert not self.loading, 'The data is being loaded'
+        if not background:
+            self.__load_data()
+            return
+
+        assert not self.concurrent, 'Background loading is not supported in concurrent mode'
+        self.loading = True
+        self.loader_error = None
+        self.loading_offsets = None
+        self.loading_progress = 0
+        self.wait_on_miss = wait_on_miss
+        self.loader = threading.Thread(target=self.__load_data, daemon=True)
+        self.loader.start()
+
+    def wait_loaded(self, timeout: Optional[float]=None) -> bool:
+        """Wait for the background loading, return False if it isn't done after `timeout` seconds"""
+        if self.loader is not None:
+            self.loader.join(timeout)
+            if self.loader.is_alive():
+                return False
+            self.loader = None
+            if self.loader_error is not None:
+                error, self.loader_error = self.loader_error, None
+                raise error
+        return True
+
+    def __load_data(self) -> None:
+        try:
+            if os.path.exists(self.fpath):
+                with self.__locked(exclusive=False):
+                    offsets, indexed_size = read_index(self.fpath)
+                    with self.loaded:
+                        self.loading_offsets = offsets
+                        self.loaded.notify_all()
+                    with open(self.fpath, 'rb') as f:
+                        self.inode = os.fstat(f.fileno()).st_ino
+                        if not self.lazy:
+                            # only read the latest records of keys covered by the index, in file order
+                            for offset in sorted(offsets.values()):
+                                f.seek(offset)
+                                key, value, timestamp = self.codec.decode(self.codec.read(f), 0)
+                                with self.loaded:
+                                    if key not in self.written:
+                                        self.data[key] = value
+                                        self.timestamps[key] = timestamp
+                                    self.loading_progress = offset + 1
+                                    self.loaded.notify_all()
+                        with self.loaded:
+                            for key, offset in offsets.items():
+                                if key not in self.written:
+                                    self.offsets[key] = offset
+                            self.loading_progress = indexed_size
+                            self.loaded.notify_all()
+                        self.__load_records(f, indexed_size)
+            else:
+                self.tail = 0
+                self.inode = None
+            self.offsets_complete = True
+        except BaseException as e:
+            if not self.loading:
+                raise
+            self.loader_error = e
+        finally:
+            with self.loaded:
+                self.loading = False
+                self.written = set()
+                if self.loader_error is None and self.offsets_complete:
+                    # the records appended after the tail of the loader are read when exiting the context
+                    self.context_tail = self.tail
+                self.loaded.notify_all()
+
+    def __wait_key_loaded(self, key: str) -> None:
+        """Wait until the loader has read the record of a key, if the key is in the index"""
+        with self.loaded:
+            while self.loading and key not in self.written:
+                if self.loading_offsets is not None:
+                    offset = self.loading_offsets.get(key, None)
+                    if offset is None and not self.wait_on_miss:
+                        return
+                    if offset is not None and self.loading_progress > offset:
+                        return
+                self.loaded.wait()
 
     def __enter__(self) -> None:
-        self.fcursor = open(self.fpath, mode='a')
+        if self.concurrent:
+            self.flock = open(self.fpath + '.lock', mode='ab')
+            # unbuffered, so that each record is appended by exactly one write call
+            self.fcursor = open(self.fpath, mode='ab', buffering=0)
+            self.freader = open(self.fpath, mode='rb')
+            if self.offsets_complete:
+                # read the records appended since the offsets were loaded, so that they stay complete
+                with self.__locked(exclusive=False):
+                    self.__sync()
+            else:
+                if self.inode is None:
+                    self.inode = os.fstat(self.freader.fileno()).st_ino
+                if self.tail is None:
+                    # only follow records written from now on
+                    self.tail = os.fstat(self.freader.fileno()).st_size
+            self.context_tail = self.tail if self.offsets_complete else None
+        else:
+            self.fcursor = open(self.fpath, mode='ab')
+            # under the lock, so that a background loader sets the tail of the context when it's done
+            with self.lock:
+                if self.offsets_complete and not self.loading:
+                    # read the records appended since the offsets were loaded, so that they stay complete
+                    self.__catch_up()
+                self.context_tail = self.tail if self.offsets_complete and not self.loading else None
         self.within_context = True
 
     def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        if self.executor is not None:
+            # wait for values that are being refreshed
+            self.executor.shutdown(wait=True)
+            self.executor = None
+        self.flush()
         self.within_context = False
-        self.fcursor.close()
+        # the index can only be written if the log is completely loaded
+        self.wait_loaded()
+        if self.concurrent:
+            with self.__locked(exclusive=True):
+                # catch up with other processes so that the index covers the whole log
+                self.__sync()
+                if self.offsets_complete:
+                    write_index(self.fpath, self.offsets, self.tail, self.inode)
+            for f in [self.fcursor, self.freader, self.flock]:
+                f.close()
+            self.freader = None
+            self.flock = None
+        else:
+            if self.offsets_complete:
+                self.fcursor.flush()
+                stat = os.fstat(self.fcursor.fileno())
+                if stat.st_ino != os.stat(self.fpath).st_ino:
+                    # the log has been replaced by another process, our records are lost with the old log
+                    self.offsets_complete = False
+                elif stat.st_size != self.tail:
+                    # other processes appended records while the log was opened, which may be interleaved with ours
+                    with open(self.fpath, 'rb') as f:
+                        self.__load_records(f, self.context_tail if self.context_tail is not None else 0)
+                if self.offsets_complete:
+                    write_index(self.fpath, self.offsets, self.tail, stat.st_ino)
+            self.fcursor.close()
+        self.fcursor = None
+        self.__unmap()
 
     def invalidate(self) -> None:
+        self.wait_loaded()
+        self.__unmap()
+        with self.lock:
+            self.__cancel_flush_timer()
+            self.pending = OrderedDict()
         if self.within_context:
             assert self.fcursor is not None
-            # attempt to close the file and open new one
-            self.fcursor.close()
-            self.fcursor = open(self.fpath, mode='w')
+            if self.concurrent:
+                with self.__locked(exclusive=True):
+                    # replace the log instead of truncating it, so other processes notice it by its inode
+                    open(self.fpath + '.tmp', 'wb').close()
+                    os.replace(self.fpath + '.tmp', self.fpath)
+                    self.__reopen()
+            else:
+                # attempt to close the file and open new one
+                self.fcursor.close()
+                self.fcursor = open(self.fpath, mode='wb')
+                self.inode = os.fstat(self.fcursor.fileno()).st_ino
+            self.context_tail = 0
         else:
             # if not in the context, mean the file is not opened
             assert self.fcursor is None
+            self.inode = None
+            if os.path.exists(self.fpath):
+                with self.__locked(exclusive=True):
+                    open(self.fpath + '.tmp', 'wb').close()
+                    os.replace(self.fpath + '.tmp', self.fpath)
+                self.inode = os.stat(self.fpath).st_ino
+        self.tail = 0
+        if os.path.exists(get_index_fpath(self.fpath)):
+            os.remove(get_index_fpath(self.fpath))
         self.data = {}
+        self.timestamps = {}
+        self.hot = OrderedDict()
+        self.offsets = {}
+        self.offsets_complete = True
+
+    def compact(self) -> None:
+        """Rewrite the log file down to the latest record of each key. It can be called inside the context (online)
+        or outside of it (offline); data that haven't been loaded are preserved.
+        """
+        self.wait_loaded()
+        if self.within_context:
+            self.flush()
+        if not os.path.exists(self.fpath):
+            return
 
-    def exec_func(self, func: Callable[[Any], Any], *args: Any) -> Any:
+        self.__unmap()
+        with self.__locked(exclusive=True):
+            if self.concurrent and self.within_context:
+                self.__sync()
+            elif self.within_context:
+                self.fcursor.close()
+            self.offsets = compact_file(self.fpath, self.codec)
+            self.offsets_complete = True
+            if self.concurrent and self.within_context:
+                self.__reopen()
+            elif self.within_context:
+                self.fcursor = open(self.fpath, mode='ab')
+            stat = os.stat(self.fpath)
+            self.tail = self.context_tail = stat.st_size
+            self.inode = stat.st_ino
+
+    def flush(self, fsync: Optional[bool]=None) -> None:
+        """Write pending records to the log in one call and flush it to the OS. The log is also fsync-ed if `fsync`
+        is True (default to the policy of the cache)"""
         assert self.within_context
+        with self.lock:
+            self.__cancel_flush_timer()
+            if len(self.pending) > 0:
+                self.__write_records([(key, record) for key, (value, timestamp, record) in self.pending.items()])
+                self.pending = OrderedDict()
+            self.fcursor.flush()
+            if fsync or (fsync is None and self.fsync):
+                os.fsync(self.fcursor.fileno())
+
+    def sync(self) -> None:
+        """Read records appended by other processes (concurrent mode)"""
+        assert self.within_context and self.concurrent
+        with self.__locked(exclusive=False):
+            self.__sync()
 
-        key = '%s:%s' % (func.__name__, ujson.dumps(args))
-        if key not in self.data:
-            self.data[key] = func(*args)
-            self.write_change(key)
+    def exec_func(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        assert self.within_context
+        namespace, key = self._build_key(func, args, kwargs)
+        return self.exec_keyed_func(namespace, key, func, args, kwargs)
 
-        return self.data[key]
+    def exec_keyed_func(self, namespace: str, key: str, func: Callable[..., Any], args: tuple,
+                        kwargs: Dict[str, Any], with_timestamp: bool=False) -> Any:
+        """Same as `exec_func` but with the namespace and key that are already computed (see `get_key`).
+
+        :param with_timestamp: return the value and the time it was written (None for records written by previous
+            versions)
+        """
+        assert self.within_context
+        counters = self.counters[namespace]
+        record = self.__get(key)
+        if record is not None:
+            value, timestamp = record
+            if not self._is_expired(namespace, timestamp):
+                counters.hits += 1
+                return record if with_timestamp else value
+            if self.stale_while_revalidate:
+                counters.hits += 1
+                self.__refresh(namespace, key, func, args, kwargs)
+                return record if with_timestamp else value
+
+        value = self.__compute(counters, func, args, kwargs)
+        timestamp = self.__put(namespace, key, value)
+        return (value, timestamp) if with_timestamp else value
+
+    async def async_exec_func(self, func: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        """Same as `exec_func` but for coroutine functions. Concurrent calls that miss the same key share
+        one computation"""
+        assert self.within_context
+        namespace, key = self._build_key(func, args, kwargs)
+        return await self.async_exec_keyed_func(namespace, key, func, args, kwargs)
+
+    async def async_exec_keyed_func(self, namespace: str, key: str, func: Callable[..., Awaitable[Any]],
+                                    args: tuple, kwargs: Dict[str, Any], with_timestamp: bool=False) -> Any:
+        """Same as `async_exec_func` but with the namespace and key that are already computed (see
+        `exec_keyed_func` for `with_timestamp`)"""
+        assert self.within_context
+        counters = self.counters[namespace]
+
+        async def compute():
+            start = time.perf_counter()
+            value = await func(*args, **kwargs)
+            counters.compute_time += time.perf_counter() - start
+            counters.misses += 1
+            return value, self.__put(namespace, key, value)
+
+        record = self.__get(key)
+        if record is not None:
+            value, timestamp = record
+            if not self._is_expired(namespace, timestamp):
+                counters.hits += 1
+                return record if with_timestamp else value
+            if self.stale_while_revalidate:
+                counters.hits += 1
+                # refresh in a task of the event loop, sharing the computation with other callers
+                asyncio.ensure_future(single_flight(self.inflight, key, compute))
+                return record if with_timestamp else value
+
+        value, timestamp = await single_flight(self.inflight, key, compute)
+        return (value, timestamp) if with_timestamp else value
+
+    def exec_batch(self,
+                   func: Callable[..., Any],
+                   args_list: List[tuple],
+                   executor: Union[None, str, Executor]=None,
+                   n_workers: Optional[int]=None,
+                   compute: Optional[Callable[..., Any]]=None) -> List[Any]:
+        """Execute a function on a list of arguments, return the results in the same order.
+
+        Cached values are looked up in one pass, then the misses are computed, optionally in parallel, and written
+        to the log in one group commit.
+
+        :param func: the cached function
+        :param args_list: list of positional arguments of each call
+        :param executor: compute the misses in the caller if None, or in a pool of workers: 'thread', 'process' or
+            an Executor
+        :param n_workers: number of workers of the pool created for 'thread' or 'process'
+        :param compute: function that computes the misses instead of `func`, e.g., a picklable equivalent for
+            process pools
+        """
+        assert self.within_context
+        if self.concurrent:
+            # catch up with other processes once instead of once per miss
+            self.sync()
+
+        namespace, keys = self._build_keys(func, args_list)
+        counters = self.counters[namespace]
+
+        values = {}  # type: Dict[str, Any]
+        misses = OrderedDict()  # type: OrderedDict[str, tuple]
+        for key, args in zip(keys, args_list):
+            if key in values or key in misses:
+                continue
+            record = self.__get(key, sync=False)
+            if record is not None:
+                value, timestamp = record
+                if not self._is_expired(namespace, timestamp):
+                    values[key] = value
+                    continue
+            misses[key] = args
+        counters.hits += len(args_list) - len(misses)
+        counters.misses += len(misses)
+
+        start = time.perf_counter()
+        computed_values = compute_batch(compute if compute is not None else func, list(misses.values()), executor,
+                                        n_workers)
+        counters.compute_time += time.perf_counter() - start
+
+        self.__put_many(namespace, list(zip(misses.keys(), computed_values)))
+        values.update(zip(misses.keys(), computed_values))
+        return [values[key] for key in keys]
 
     def write_change(self, key: str) -> None:
-        self.fcursor.write(ujson.dumps((key, self.data[key])))
-        self.fcursor.write('\n')
+        self.__append(key, self.data[key], self.timestamps[key])
+
+    def __refresh(self, namespace: str, key: str, func: Callable[..., Any], args: tuple, kwargs: Dict[str, Any]):
+        """Recompute an entry in the background thread, unless it's being refreshed"""
+        with self.lock:
+            if key in self.refreshing:
+                return
+            self.refreshing.add(key)
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=1)
+
+        def refresh():
+            try:
+                self.__put(namespace, key, self.__compute(self.counters[namespace], func, args, kwargs))
+            finally:
+                with self.lock:
+                    self.refreshing.discard(key)
+
+        self.executor.submit(refresh)
+
+    def __compute(self, counters: CacheStats, func: Callable[..., Any], args: tuple, kwargs: Dict[str, Any]) -> Any:
+        start = time.perf_counter()
+        value = func(*args, **kwargs)
+        counters.compute_time += time.perf_counter() - start
+        counters.misses += 1
+        return value
+
+    def __contains(self, key: str, sync: bool=True) -> bool:
+        if self.loading:
+            self.__wait_key_loaded(key)
+        if key in self.data or (self.lazy and (key in self.pending or key in self.offsets)):
+            return True
+        if self.concurrent and sync:
+            # the value may have been computed by another process
+            self.sync()
+            return key in self.data or (self.lazy and key in self.offsets)
+        return False
+
+    def __get(self, key: str, sync: bool=True) -> Optional[Tuple[Any, Optional[float]]]:
+        """Get value and timestamp of a key, None if the key is missing"""
+        if not self.__contains(key, sync):
+            return None
+        if key in self.data:
+            return self.data[key], self.timestamps[key]
+        return self.__read_value(key)
+
+    def __put(self, namespace: str, key: str, value: Any) -> float:
+        """Store the value of a key and write it to the log, return the time it's written"""
+        timestamp = time.time()
+        with self.lock:
+            if self.loading:
+                self.written.add(key)
+            if self.lazy:
+                # keep only the log record, the value is read back from the log when it isn't hot anymore
+                nbytes = self.__append(key, value, timestamp)
+                self._add_hot(key, (value, timestamp))
+            else:
+                self.data[key] = value
+                self.timestamps[key] = timestamp
+                nbytes = self.__append(key, value, timestamp)
+            self.counters[namespace].bytes_written += nbytes
+        return timestamp
+
+    def __put_many(self, namespace: str, items: List[Tuple[str, Any]]) -> None:
+        """Store values of several keys and write them to the log in one call"""
+        timestamp = time.time()
+        with self.lock:
+            records = []
+            for key, value in items:
+                if self.loading:
+                    self.written.add(key)
+                if self.lazy:
+                    self._add_hot(key, (value, timestamp))
+                else:
+                    self.data[key] = value
+                    self.timestamps[key] = timestamp
+                records.append((key, value, timestamp, self.codec.encode(key, value, timestamp)))
+            self.counters[namespace].bytes_written += sum(len(record[3]) for record in records)
+
+            if self.flush_every is None and self.flush_interval is None:
+                self.__write_records([(key, record) for key, value, timestamp, record in records])
+            else:
+                # pending records are written in the same call
+                for key, value, timestamp, record in records:
+                    self.pending[key] = (value, timestamp, record)
+                self.flush()
+
+    def __append(self, key: str, value: Any, timestamp: Optional[float]) -> int:
+        """Write a record to the log (or the pending records), return its size"""
+        record = self.codec.encode(key, value, timestamp)
+        if self.flush_every is None and self.flush_interval is None:
+            self.__write_records([(key, record)])
+            return len(record)
+
+        with self.lock:
+            self.pending[key] = (value, timestamp, record)
+            if self.flush_every is not None and len(self.pending) >= self.flush_every:
+                self.flush()
+            elif self.flush_interval is not None and self.flush_timer is None:
+                self.flush_timer = threading.Timer(self.flush_interval / 1000, self.__flush_on_timer)
+                self.flush_timer.daemon = True
+                self.flush_timer.start()
+        return len(record)
+
+    def __flush_on_timer(self) -> None:
+        with self.lock:
+            if self.within_context:
+                self.flush()
+
+    def __cancel_flush_timer(self) -> None:
+        if self.flush_timer is not None:
+            self.flush_timer.cancel()
+            self.flush_timer = None
+
+    def __write_records(self, records: List[Tuple[str, bytes]]) -> None:
+        """Append encoded records to the log in one write call, offsets of the keys are only updated afterward
+        so that readers never see an offset of an unwritten record"""
+        buffer = b''.join(record for key, record in records)
+        if not self.concurrent:
+            offset = self.fcursor.tell()
+            self.fcursor.write(buffer)
+            if self.offsets_complete and not self.loading:
+                self.tail += len(buffer)
+        else:
+            with self.__locked(exclusive=True):
+                # read records of other processes first, so that the tail ends right before our records
+                self.__sync()
+                offset = self.tail
+                self.fcursor.write(buffer)
+                self.tail += len(buffer)
+
+        for key, record in records:
+            self.offsets[key] = offset
+            offset += len(record)
+
+    def __load_records(self, f: BinaryIO, offset: int) -> None:
+        """Load complete records of the log from the offset, and move the tail to the end of the last one"""
+        self.tail = offset
+        if self.lazy:
+            for offset, length, key in self.codec.scan(f, offset):
+                with self.lock:
+                    if key not in self.written:
+                        self.hot.pop(key, None)
+                        self.offsets[key] = offset
+                self.tail = offset + length
+        else:
+            f.seek(offset)
+            record = self.codec.read(f)
+            while record is not None:
+                key, value, timestamp = self.codec.decode(record, 0)
+                with self.lock:
+                    if key not in self.written:
+                        self.data[key] = value
+                        self.timestamps[key] = timestamp
+                        self.offsets[key] = self.tail
+                self.tail += len(record)
+                record = self.codec.read(f)
+
+    def __sync(self) -> None:
+        """Read records appended after the tail, the lock must be held by the caller"""
+        stat = os.stat(self.fpath)
+        if stat.st_ino != self.inode or stat.st_size < self.tail:
+            # the log has been replaced (compacted or invalidated) by another process
+            self.__reopen()
+            self.__reset()
+        self.__load_records(self.freader, self.tail)
+
+    def __catch_up(self) -> None:
+        """Read records appended after the tail by other processes (non-concurrent mode), e.g., between loading
+        the log and entering the context"""
+        stat = os.fstat(self.fcursor.fileno())
+        if stat.st_ino != self.inode or stat.st_size < self.tail:
+            # the log has been replaced (or created) by another process
+            self.inode = stat.st_ino
+            self.__reset()
+        if stat.st_size > self.tail:
+            with open(self.fpath, 'rb') as f:
+                self.__load_records(f, self.tail)
+
+    def __reset(self) -> None:
+        self.data = {}
+        self.timestamps = {}
+        self.hot = OrderedDict()
+        self.offsets = {}
+        self.offsets_complete = True
+        self.tail = 0
+
+    def __reopen(self) -> None:
+        self.__unmap()
+        self.fcursor.close()
+        self.freader.close()
+        self.fcursor = open(self.fpath, mode='ab', buffering=0)
+        self.freader = open(self.fpath, mode='rb')
+        self.inode = os.fstat(self.freader.fileno()).st_ino
+        self.tail = 0
+
+    @contextmanager
+    def __locked(self, exclusive: bool) -> Iterator[None]:
+        """Hold the advisory lock of the log in concurrent mode, do nothing otherwise"""
+        if not self.concurrent:
+            yield
+            return
+
+        flock = self.flock if self.flock is not None else open(self.fpath + '.lock', mode='ab')
+        fcntl.flock(flock.fileno(), fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        try:
+            yield
+        finally:
+            fcntl.flock(flock.fileno(), fcntl.LOCK_UN)
+            if flock is not self.flock:
+                flock.close()
+
+    def __read_value(self, key: str) -> Optional[Tuple[Any, Optional[float]]]:
+        """Read value and timestamp of a key from the hot values or decode it from the memory-mapped log, return
+        None if the record at the offset of the key is another key's (the offset is outdated)"""
+        with self.lock:
+            record = self.pending.get(key)
+            if record is not None:
+                return record[0], record[1]
+            if key in self.hot:
+                self.hot.move_to_end(key)
+                return self.hot[key]
+
+            offset = self.offsets[key]
+            if self.mmap is None or offset >= len(self.mmap):
+                # the record is written after the log was mapped
+                self.__remap()
+            record_key, value, timestamp = self.codec.decode(self.mmap, offset)
+            if record_key != key:
+                del self.offsets[key]
+                return None
+            self._add_hot(key, (value, timestamp))
+            return value, timestamp
+
+    def __remap(self) -> None:
+        self.__unmap()
+        if self.fcursor is not None:
+            self.fcursor.flush()
+        with open(self.fpath, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __unmap(self) -> None:
+        if self.mmap is not None:
+            try:
+                self.mmap.close()
+            except BufferError:
+                # decoded values (e.g., arrays of BinaryCodec) still use the map, it's released with them
+                pass
+            self.mmap = None
+
+
+class SqliteFileCache(BaseCache):
+    """Cache results of functions in a SQLite database, a drop-in replacement of FileCache for caches that are too
+    large to be kept in memory: values are only read when they are looked up, and the most recently used
+    `hot_size` values are kept in memory.
+
+    Each function has its own table indexed by the keys, so that a function can be invalidated on its own
+    (`invalidate_func`). The database is in WAL mode so that readers of other processes aren't blocked by writers.
+    Values are pickled. Records are written as soon as they are computed, unless `flush_every` is set: they are
+    then inserted in one transaction every `flush_every` records, when `flush` is called, or when exiting the
+    context.
+    """
+
+    def __init__(self,
+                 fpath: str,
+                 hot_size: int=0,
+                 flush_every: Optional[int]=None,
+                 fsync: bool=False,
+                 key_builder: Optional[KeyBuilder]=None,
+                 ttl: Optional[float]=None,
+                 timeout: float=30.0) -> None:
+        """
+        :param fpath: path of the database
+        :param hot_size: number of values kept in memory
+        :param flush_every: number of records inserted in one transaction, each record is inserted in its own
+            transaction if None
+        :param fsync: sync the database to the disk on every commit (synchronous=FULL) instead of on checkpoints
+        :param key_builder: build keys of function calls, default is HashKeyBuilder
+        :param ttl: default time-to-live (seconds) of entries, never expire if None
+        :param timeout: seconds to wait for the lock of the database held by other processes
+        """
+        self.fpath = fpath
+        self.hot_size = hot_size
+        self.flush_every = flush_every
+        self.fsync = fsync
+        super().__init__(key_builder, ttl)
+        self.timeout = timeout
+
+        self.conn = None  # type: Optional[sqlite3.Connection]
+        self.tables = set()  # type: Set[str]
+        self.within_context = False
+        self.lock = threading.RLock()
+        # key => (value, timestamp)
+        self.hot = OrderedDict()  # type: OrderedDict[str, Tuple[Any, Optional[float]]]
+        # records waiting to be inserted: namespace => {key => (value, timestamp, pickled value)}
+        self.pending = {}  # type: Dict[str, Dict[str, Tuple[Any, float, bytes]]]
+        self.n_pending = 0
+        self.inflight = {}  # type: Dict[str, asyncio.Future]
+
+    def load_data(self, background: bool=False, wait_on_miss: bool=False) -> None:
+        """Open the database, values are read on demand so nothing is loaded (the arguments are only for
+        compatibility with FileCache)"""
+        assert not self.within_context, 'Must load the data before caching'
+        self.__connect()
+
+    def wait_loaded(self, timeout: Optional[float]=None) -> bool:
+        return True
+
+    def __enter__(self) -> None:
+        self.__connect()
+        self.within_context = True
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.flush()
+        self.within_context = False
+        with self.lock:
+            self.conn.close()
+            self.conn = None
+
+    def invalidate(self) -> None:
+        """Drop the tables of every function"""
+        with self.lock:
+            self.__connect()
+            tables = [row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+            for table in tables:
+                self.conn.execute('DROP TABLE %s' % self.__quote(table))
+            self.tables = set()
+            self.hot = OrderedDict()
+            self.pending = {}
+            self.n_pending = 0
+
+    def invalidate_func(self, func: Callable[..., Any]) -> None:
+        """Drop the table of a function, entries of other functions are kept"""
+        namespace = self.key_builder.namespace(func)
+        with self.lock:
+            self.__connect()
+            self.conn.execute('DROP TABLE IF EXISTS %s' % self.__quote(namespace))
+            self.tables.discard(namespace)
+            self.n_pending -= len(self.pending.pop(namespace, {}))
+            prefix = namespace + ':'
+            for key in [key for key in self.hot if key.startswith(prefix)]:
+                del self.hot[key]
+
+    def compact(self) -> None:
+        """Reclaim the space of dropped tables and replaced records"""
+        with self.lock:
+            if self.within_context:
+                self.flush()
+            self.__connect()
+            self.conn.execute('VACUUM')
+
+    def flush(self, fsync: Optional[bool]=None) -> None:
+        """Insert pending records in one transaction. The argument is only for compatibility with FileCache, the
+        durability of commits is set by the `fsync` option"""
+        with self.lock:
+            if self.n_pending == 0:
+                return
+            self.conn.execute('BEGIN')
+            try:
+                for namespace, records in self.pending.items():
+                    # the table may have been dropped by another process
+                    self.conn.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, value BLOB, ts REAL) '
+                                      'WITHOUT ROWID' % self.__quote(namespace))
+                    self.tables.add(namespace)
+                    self.conn.executemany(
+                        'INSERT OR REPLACE INTO %s VALUES (?, ?, ?)' % self.__quote(namespace),
+                        [(key[len(namespace) + 1:], blob, timestamp)
+                         for key, (value, timestamp, blob) in records.items()])
+            except BaseException:
+                self.conn.execute('ROLLBACK')
+                raise
+            self.conn.execute('COMMIT')
+            self.pending = {}
+            self.n_pending = 0
+
+    def exec_func(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        assert self.within_context
+        namespace, key = self._build_key(func, args, kwargs)
+        return self.exec_keyed_func(namespace, key, func, args, kwargs)
+
+    def exec_keyed_func(self, namespace: str, key: str, func: Callable[..., Any], args: tuple,
+                        kwargs: Dict[str, Any]) -> Any:
+        """Same as `exec_func` but with the namespace and key that are already computed (see `get_key`)"""
+        assert self.within_context
+        counters = self.counters[namespace]
+        record = self.__get(namespace, key)
+        if record is not None and not self._is_expired(namespace, record[1]):
+            counters.hits += 1
+            return record[0]
+
+        start = time.perf_counter()
+        value = func(*args, **kwargs)
+        counters.compute_time += time.perf_counter() - start
+        counters.misses += 1
+        self.__put_many(namespace, [(key, value)])
+        return value
+
+    async def async_exec_func(self, func: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        """Same as `exec_func` but for coroutine functions. Concurrent calls that miss the same key share
+        one computation"""
+        assert self.within_context
+        namespace, key = self._build_key(func, args, kwargs)
+        return await self.async_exec_keyed_func(namespace, key, func, args, kwargs)
+
+    async def async_exec_keyed_func(self, namespace: str, key: str, func: Callable[..., Awaitable[Any]],
+                                    args: tuple, kwargs: Dict[str, Any]) -> Any:
+        """Same as `async_exec_func` but with the namespace and key that are already computed"""
+        assert self.within_context
+        counters = self.counters[namespace]
+
+        async def compute():
+            start = time.perf_counter()
+            value = await func(*args, **kwargs)
+            counters.compute_time += time.perf_counter() - start
+            counters.misses += 1
+            self.__put_many(namespace, [(key, value)])
+            return value
+
+        record = self.__get(namespace, key)
+        if record is not None and not self._is_expired(namespace, record[1]):
+            counters.hits += 1
+            return record[0]
+        return await single_flight(self.inflight, key, compute)
+
+    def exec_batch(self,
+                   func: Callable[..., Any],
+                   args_list: List[tuple],
+                   executor: Union[None, str, Executor]=None,
+                   n_workers: Optional[int]=None,
+                   compute: Optional[Callable[..., Any]]=None) -> List[Any]:
+        """Execute a function on a list of arguments, return the results in the same order (see
+        `FileCache.exec_batch`). Cached values are selected in a few queries, and the misses are inserted in one
+        transaction"""
+        assert self.within_context
+        namespace, keys = self._build_keys(func, args_list)
+        counters = self.counters[namespace]
+
+        values = {}  # type: Dict[str, Any]
+        for key, (value, timestamp) in self.__get_many(namespace, set(keys)).items():
+            if not self._is_expired(namespace, timestamp):
+                values[key] = value
+        misses = OrderedDict()  # type: OrderedDict[str, tuple]
+        for key, args in zip(keys, args_list):
+            if key not in values:
+                misses[key] = args
+        counters.hits += len(args_list) - len(misses)
+        counters.misses += len(misses)
+
+        start = time.perf_counter()
+        computed_values = compute_batch(compute if compute is not None else func, list(misses.values()), executor,
+                                        n_workers)
+        counters.compute_time += time.perf_counter() - start
+
+        items = list(zip(misses.keys(), computed_values))
+        with self.lock:
+            self.__put_many(namespace, items, flush=False)
+            self.flush()
+        values.update(items)
+        return [values[key] for key in keys]
+
+    def __connect(self) -> None:
+        with self.lock:
+            if self.conn is not None:
+                return
+            # transactions are managed explicitly (isolation_level=None), the lock guards the connection
+            self.conn = sqlite3.connect(self.fpath, timeout=self.timeout, isolation_level=None,
+                                        check_same_thread=False)
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=%s' % ('FULL' if self.fsync else 'NORMAL'))
+            self.tables = {row[0] for row in self.conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+    def __quote(self, namespace: str) -> str:
+        return '"%s"' % namespace.replace('"', '""')
+
+    def __select(self, namespace: str, query: str, params: List[Any]) -> List[tuple]:
+        """Run a query (with `%s` in place of the table name) on the table of a function. Tables are created and
+        dropped by other processes too, so a table that isn't known is looked up again, and a missing table has no
+        rows"""
+        if namespace not in self.tables:
+            if self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                 (namespace,)).fetchone() is None:
+                return []
+            self.tables.add(namespace)
+        try:
+            return self.conn.execute(query % self.__quote(namespace), params).fetchall()
+        except sqlite3.OperationalError as e:
+            if 'no such table' not in str(e):
+                raise
+            self.tables.discard(namespace)
+            return []
+
+    def __get(self, namespace: str, key: str) -> Optional[Tuple[Any, Optional[float]]]:
+        """Get value and timestamp of a key, None if the key isn't in the cache"""
+        with self.lock:
+            if key in self.hot:
+                self.hot.move_to_end(key)
+                return self.hot[key]
+            records = self.pending.get(namespace, None)
+            if records is not None and key in records:
+                return records[key][:2]
+            rows = self.__select(namespace, 'SELECT value, ts FROM %s WHERE key = ?', [key[len(namespace) + 1:]])
+            if len(rows) == 0:
+                return None
+            record = (pickle.loads(rows[0][0]), rows[0][1])
+            self._add_hot(key, record)
+            return record
+
+    def __get_many(self, namespace: str, keys: Set[str]) -> Dict[str, Tuple[Any, Optional[float]]]:
+        """Get values and timestamps of the keys that are in the cache"""
+        records = {}  # type: Dict[str, Tuple[Any, Optional[float]]]
+        with self.lock:
+            pending = self.pending.get(namespace, {})
+            missing_keys = []
+            for key in keys:
+                if key in self.hot:
+                    records[key] = self.hot[key]
+                elif key in pending:
+                    records[key] = pending[key][:2]
+                else:
+                    missing_keys.append(key[len(namespace) + 1:])
+
+            # stay below the limit of the number of parameters of a query
+            batch_size = 500
+            for i in range(0, len(missing_keys), batch_size):
+                batch = missing_keys[i:i + batch_size]
+                rows = self.__select(namespace, 'SELECT key, value, ts FROM %%s WHERE key IN (%s)' % ','.join(
+                    '?' * len(batch)), batch)
+                for argkey, value, timestamp in rows:
+                    key = '%s:%s' % (namespace, argkey)
+                    records[key] = (pickle.loads(value), timestamp)
+                    self._add_hot(key, records[key])
+        return records
+
+    def __put_many(self, namespace: str, items: List[Tuple[str, Any]], flush: bool=True) -> None:
+        timestamp = time.time()
+        with self.lock:
+            records = self.pending.setdefault(namespace, {})
+            for key, value in items:
+                blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+                if key not in records:
+                    self.n_pending += 1
+                records[key] = (value, timestamp, blob)
+                self._add_hot(key, (value, timestamp))
+                self.counters[namespace].bytes_written += len(blob)
+            if flush and (self.flush_every is None or self.n_pending >= self.flush_every):
+                self.flush()
+
+
+
+class SharedMemoryCache(BaseCache):
+    """Cache results of functions in an anonymous shared memory map, so that processes forked after the cache is
+    created (e.g., workers of a multiprocessing pool) read each other's results without going through a manager
+    process. The cache can't be sent to processes that aren't forked.
+
+    The map holds a hash table of `n_slots` slots (open addressing, at most `max_size` entries) and an append-only
+    arena of `max_bytes` bytes where values are stored as BinaryCodec records: arrays are read-only views of the
+    map. Once the table or the arena is full, new values are still computed but aren't cached. Replaced values
+    aren't reclaimed.
+
+    Writers are serialized by a process-shared lock; readers don't take it, they read a slot again if its version
+    changed (a writer increments it before and after updating the slot). Counters and time-to-live of functions are
+    those of the current process.
+    """
+
+    # used bytes of the arena, number of entries
+    header = struct.Struct('<QQ')
+    # version, digest of the key, offset of the record (0 if the slot is empty)
+    slot = struct.Struct('<Q16sQ')
+    version = struct.Struct('<Q')
+
+    def __init__(self,
+                 max_size: int=65536,
+                 max_bytes: int=64 * 1024 * 1024,
+                 key_builder: Optional[KeyBuilder]=None,
+                 ttl: Optional[float]=None) -> None:
+        """
+        :param max_size: maximum number of entries
+        :param max_bytes: size of the arena of the values
+        :param key_builder: build keys of function calls, default is HashKeyBuilder
+        :param ttl: default time-to-live (seconds) of entries, never expire if None
+        """
+        self.max_size = max_size
+        # keep the load factor of the table under 0.75
+        self.n_slots = 1 << (max_size * 4 // 3).bit_length()
+        self.arena_start = BinaryCodec.alignment * math.ceil(
+            (self.header.size + self.n_slots * self.slot.size) / BinaryCodec.alignment)
+        self.mmap = mmap.mmap(-1, self.arena_start + max_bytes)
+        # values are decoded from a read-only view so that arrays can't modify the map
+        self.view = memoryview(self.mmap).toreadonly()
+        self.write_lock = multiprocessing.Lock()
+        self.codec = BinaryCodec()
+        super().__init__(key_builder, ttl)
+
+    def __len__(self) -> int:
+        return self.header.unpack_from(self.mmap, 0)[1]
+
+    def exec_func(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        namespace, key = self._build_key(func, args, kwargs)
+        return self.exec_keyed_func(namespace, key, func, args, kwargs)
+
+    def exec_keyed_func(self, namespace: str, key: str, func: Callable[..., Any], args: tuple,
+                        kwargs: Dict[str, Any]) -> Any:
+        """Same as `exec_func` but with the namespace and key that are already computed"""
+        counters = self.counters[namespace]
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        record = self.__get(key, digest)
+        if record is not None and not self._is_expired(namespace, record[1]):
+            counters.hits += 1
+            return record[0]
+
+        start = time.perf_counter()
+        value = func(*args, **kwargs)
+        counters.compute_time += time.perf_counter() - start
+        counters.misses += 1
+        counters.bytes_written += self.__put(key, digest, value)
+        return value
+
+    def __read_slot(self, pos: int) -> Tuple[bytes, int]:
+        """Read digest and offset of a slot that isn't being written"""
+        while True:
+            version, digest, offset = self.slot.unpack_from(self.mmap, pos)
+            if version % 2 == 0 and self.version.unpack_from(self.mmap, pos)[0] == version:
+                return digest, offset
+            # a writer is updating the slot
+            time.sleep(0)
+
+    def __get(self, key: str, digest: bytes) -> Optional[Tuple[Any, Optional[float]]]:
+        mask = self.n_slots - 1
+        i = int.from_bytes(digest[:8], 'little') & mask
+        for _ in range(self.n_slots):
+            slot_digest, offset = self.__read_slot(self.header.size + i * self.slot.size)
+            if offset == 0:
+                return None
+            if slot_digest == digest:
+                record_key, value, timestamp = self.codec.decode(self.view, offset)
+                if record_key == key:
+                    return value, timestamp
+            i = (i + 1) & mask
+        return None
+
+    def __put(self, key: str, digest: bytes, value: Any) -> int:
+        """Store a value, return the size of its record (0 if the cache is full)"""
+        record = self.codec.encode(key, value, time.time())
+        mask = self.n_slots - 1
+        with self.write_lock:
+            used, n_entries = self.header.unpack_from(self.mmap, 0)
+            offset = self.arena_start + used
+            if offset + len(record) > len(self.mmap):
+                return 0
+
+            i = int.from_bytes(digest[:8], 'little') & mask
+            while True:
+                pos = self.header.size + i * self.slot.size
+                version, slot_digest, slot_offset = self.slot.unpack_from(self.mmap, pos)
+                if slot_offset == 0 or slot_digest == digest:
+                    break
+                i = (i + 1) & mask
+            if slot_offset == 0:
+                if n_entries >= self.max_size:
+                    return 0
+                n_entries += 1
+
+            # the record is written before it's referenced by the slot
+            self.mmap[offset:offset + len(record)] = record
+            self.version.pack_into(self.mmap, pos, version + 1)
+            self.slot.pack_into(self.mmap, pos, version + 1, digest, offset)
+            self.version.pack_into(self.mmap, pos, version + 2)
+            self.header.pack_into(self.mmap, 0, used + len(record), n_entries)
+        return len(record)
+
+
+class ShardedFileCache(BaseCache):
+    """Spread the keys of a FileCache over `n_shards` files (`<fpath>.<i>`) by the hash of the keys, so that each
+    shard can be loaded, invalidated or compacted on its own (e.g., only the shards that are used can be loaded).
+
+    The shards share the options of FileCache (kwargs) and one key builder. A key always goes to the same shard
+    (the hash is stable across processes), so the number of shards must not change once the files are written.
+    The time spent building keys is counted by the sharded cache, the other counters by the shards.
+    """
+
+    def __init__(self, fpath: str, n_shards: int, **kwargs: Any) -> None:
+        assert n_shards > 0
+        self.fpath = fpath
+        self.n_shards = n_shards
+        if kwargs.get('key_builder', None) is None:
+            kwargs['key_builder'] = HashKeyBuilder()
+        super().__init__(kwargs['key_builder'], kwargs.get('ttl', None))
+        self.shards = [FileCache(self.get_shard_fpath(i), **kwargs) for i in range(n_shards)]
+
+    def get_shard_fpath(self, shard: int) -> str:
+        return '%s.%d' % (self.fpath, shard)
+
+    def get_shard(self, key: str) -> FileCache:
+        return self.shards[zlib.crc32(key.encode('utf-8')) % self.n_shards]
+
+    def load_data(self, n_workers: Optional[int]=None, background: bool=False, wait_on_miss: bool=False) -> None:
+        """Load the shards in a pool of `n_workers` threads (one per shard by default), or in the background
+        thread of each shard (see `FileCache.load_data`).
+
+        The threads only overlap the reads of the files: decoding the records holds the GIL, so loading the shards
+        of a log isn't faster than loading the log when the files are in the page cache.
+        """
+        if background:
+            for shard in self.shards:
+                shard.load_data(background, wait_on_miss)
+            return
+        with ThreadPoolExecutor(max_workers=n_workers or self.n_shards) as pool:
+            # list() to re-raise the errors of the workers
+            list(pool.map(FileCache.load_data, self.shards))
+
+    def __enter__(self) -> None:
+        for shard in self.shards:
+            shard.__enter__()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        for shard in self.shards:
+            shard.__exit__(exc_type, exc_val, exc_tb)
+
+    def invalidate(self, shard: Optional[int]=None) -> None:
+        """Invalidate one shard, or every shard if None"""
+        for file_cache in self.__select(shard):
+            file_cache.invalidate()
+
+    def compact(self, shard: Optional[int]=None) -> None:
+        """Compact one shard, or every shard if None"""
+        for file_cache in self.__select(shard):
+            file_cache.compact()
+
+    def flush(self, fsync: Optional[bool]=None) -> None:
+        for shard in self.shards:
+            shard.flush(fsync)
+
+    def stats(self) -> Dict[str, Dict[str, Union[int, float]]]:
+        """Counters of each function namespace, summed over the shards"""
+        counters = defaultdict(CacheStats)  # type: Dict[str, CacheStats]
+        for cache in [self] + self.shards:
+            for namespace, cache_counters in cache.counters.items():
+                counters[namespace].update(cache_counters)
+        return {namespace: namespace_counters.to_dict() for namespace, namespace_counters in counters.items()}
+
+    def reset_stats(self) -> None:
+        super().reset_stats()
+        for shard in self.shards:
+            shard.reset_stats()
+
+    def set_ttl(self, func: Callable[..., Any], ttl: Optional[float]) -> None:
+        super().set_ttl(func, ttl)
+        for shard in self.shards:
+            shard.set_ttl(func, ttl)
+
+    def exec_func(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        namespace, key = self._build_key(func, args, kwargs)
+        return self.get_shard(key).exec_keyed_func(namespace, key, func, args, kwargs)
+
+    async def async_exec_func(self, func: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        namespace, key = self._build_key(func, args, kwargs)
+        return await self.get_shard(key).async_exec_keyed_func(namespace, key, func, args, kwargs)
+
+    def exec_batch(self,
+                   func: Callable[..., Any],
+                   args_list: List[tuple],
+                   executor: Union[None, str, Executor]=None,
+                   n_workers: Optional[int]=None,
+                   compute: Optional[Callable[..., Any]]=None) -> List[Any]:
+        """Same as `FileCache.exec_batch`, the arguments are grouped by shards and each group is one batch"""
+        groups = defaultdict(list)  # type: Dict[int, List[int]]
+        for i, args in enumerate(args_list):
+            groups[zlib.crc32(self.get_key(func, args, {}).encode('utf-8')) % self.n_shards].append(i)
+
+        if isinstance(executor, str):
+            # share one pool between the shards
+            with {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}[executor](max_workers=n_workers) as pool:
+                return self.exec_batch(func, args_list, pool, n_workers, compute)
+
+        values = [None] * len(args_list)  # type: List[Any]
+        for shard, idxs in groups.items():
+            shard_values = self.shards[shard].exec_batch(func, [args_list[i] for i in idxs], executor, n_workers,
+                                                         compute)
+            for i, value in zip(idxs, shard_values):
+                values[i] = value
+        return values
+
+    def __select(self, shard: Optional[int]) -> List[FileCache]:
+        return self.shards if shard is None else [self.shards[shard]]
+
+
+class TieredCache(object):
+    """Two-tier cache: a bounded in-memory Cache in front of a lazy FileCache.
+
+    Values are looked up in the memory tier first, then in the log (decoded on demand), and are only computed if
+    both tiers miss. Values read from the log or computed are promoted to the memory tier; values evicted from the
+    memory tier are still in the log, so demotion doesn't write anything. The cold tail of the cache stays on
+    disk, only its keys and offsets are in memory.
+
+    The memory tier uses the ttl of the disk tier, counted from the time the value was written to the log, so a
+    promoted value expires at the same time in both tiers.
+    """
+
+    def __init__(self,
+                 fpath: str,
+                 max_size: Optional[int]=None,
+                 max_bytes: Optional[int]=None,
+                 eviction: Union[str, Callable[[], EvictionPolicy]]='lru',
+                 sizeof: Callable[[Any], int]=approx_sizeof,
+                 **kwargs: Any) -> None:
+        """
+        :param fpath: path of the cache file
+        :param max_size: maximum number of entries of each function in the memory tier
+        :param max_bytes: approximate memory budget of each function in the memory tier
+        :param eviction: eviction policy of the memory tier ('lru' or 'lfu')
+        :param sizeof: function to estimate the size of a cached value
+        :param kwargs: options of the FileCache (disk tier), which is always lazy
+        """
+        assert max_size is not None or max_bytes is not None, 'The memory tier must be bounded'
+        if kwargs.get('key_builder', None) is None:
+            kwargs['key_builder'] = HashKeyBuilder()
+        kwargs['lazy'] = True
+        self.key_builder = kwargs['key_builder']  # type: KeyBuilder
+        self.memory = Cache(max_size, max_bytes, eviction, sizeof, key_builder=self.key_builder,
+                            ttl=kwargs.get('ttl', None))
+        self.disk = FileCache(fpath, **kwargs)
+
+    def load_data(self, background: bool=False, wait_on_miss: bool=False) -> None:
+        self.disk.load_data(background, wait_on_miss)
+
+    def __enter__(self) -> None:
+        self.disk.__enter__()
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.disk.__exit__(exc_type, exc_val, exc_tb)
+
+    def invalidate(self) -> None:
+        self.memory.clear()
+        self.disk.invalidate()
+
+    def compact(self) -> None:
+        self.disk.compact()
+
+    def flush(self, fsync: Optional[bool]=None) -> None:
+        self.disk.flush(fsync)
+
+    def stats(self) -> Dict[str, Dict[str, Dict[str, Union[int, float]]]]:
+        """Counters of each tier: a miss of the memory tier is a lookup of the disk tier, and a miss of the disk
+        tier is a computation"""
+        return {'memory': self.memory.stats(), 'disk': self.disk.stats()}
+
+    def reset_stats(self) -> None:
+        self.memory.reset_stats()
+        self.disk.reset_stats()
+
+    def set_ttl(self, func: Callable[..., Any], ttl: Optional[float]) -> None:
+        self.memory.set_ttl(func, ttl)
+        self.disk.set_ttl(func, ttl)
+
+    def exec_func(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        assert self.disk.within_context
+        namespace, key = self.memory._build_key(func, args, kwargs)
+        return self.memory.exec_keyed_func(
+            namespace, key, self.disk.exec_keyed_func, (namespace, '%s:%s' % (namespace, key), func, args, kwargs),
+            {'with_timestamp': True}, timestamped=True)
+
+    async def async_exec_func(self, func: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> Any:
+        assert self.disk.within_context
+        namespace, key = self.memory._build_key(func, args, kwargs)
+        return await self.memory.async_exec_keyed_func(
+            namespace, key, self.disk.async_exec_keyed_func,
+            (namespace, '%s:%s' % (namespace, key), func, args, kwargs), {'with_timestamp': True}, timestamped=True)
+
+
+def apply_args(func: Callable[..., Any], args: tuple) -> Any:
+    return func(*args)
+
+
+def compute_batch(compute: Callable[..., Any],
+                  args_list: List[tuple],
+                  executor: Union[None, str, Executor]=None,
+                  n_workers: Optional[int]=None) -> List[Any]:
+    """Call a function on a list of arguments in the caller, or in a pool of workers ('thread', 'process' or an
+    Executor)"""
+    if len(args_list) == 0:
+        return []
+    if executor is None:
+        return [compute(*args) for args in args_list]
+
+    if isinstance(executor, Executor):
+        pool = executor
+    else:
+        pool = {'thread': ThreadPoolExecutor, 'process': ProcessPoolExecutor}[executor](max_workers=n_workers)
+    try:
+        chunksize = 1
+        if isinstance(pool, ProcessPoolExecutor):
+            # send the arguments to processes in chunks to reduce the communication overhead
+            chunksize = max(1, len(args_list) // ((n_workers or os.cpu_count() or 1) * 4))
+        return list(pool.map(apply_args, repeat(compute), args_list, chunksize=chunksize))
+    finally:
+        if pool is not executor:
+            pool.shutdown()
+
+
+# object of FileCacheDelegator in a worker process of `FileCacheDelegator.exec_batch`
+worker_object = None  # type: object
+
+
+def init_worker_object(object_constructor: Callable[[], object]) -> None:
+    global worker_object
+    worker_object = object_constructor()
+
+
+def call_worker_object(func_name: str, *args: Any) -> Any:
+    return getattr(worker_object, func_name)(*args)
+
+
+FILE_CACHE_BACKENDS = {
+    'log': FileCache,
+    'sqlite': SqliteFileCache,
+}
 
 
 class FileCacheDelegator(object):
-    def __init__(self, fpath: str, object_constructor: Callable[[], object]) -> None:
-        self.file_cache: FileCache = FileCache(fpath)
+    def __init__(self, fpath: str, object_constructor: Callable[[], object], backend: str='log', **kwargs: Any) -> None:
+        """
+        :param fpath: path of the cache file
+        :param object_constructor: construct the object that the calls are delegated to, only called on a miss
+        :param backend: storage of the cache: 'log' (FileCache) or 'sqlite' (SqliteFileCache)
+        :param kwargs: options of the storage (e.g., lazy, codec)
+        """
+        self.file_cache: Union[FileCache, SqliteFileCache] = FILE_CACHE_BACKENDS[backend](fpath, **kwargs)
         self.object_constructor: Callable[[], object] = object_constructor
         self.object: object = None  # type: object
+        self.object_lock = threading.Lock()
         self.delegator = {}  # type: Dict[str, Callable[[*Any], Any]]
 
-    def load_data(self) -> None:
-        self.file_cache.load_data()
+    def load_data(self, background: bool=False, wait_on_miss: bool=False) -> None:
+        self.file_cache.load_data(background, wait_on_miss)
+
+    def wait_loaded(self, timeout: Optional[float]=None) -> bool:
+        return self.file_cache.wait_loaded(timeout)
 
     def __enter__(self):
         self.file_cache.__enter__()
@@ -94,18 +2231,57 @@ class FileCacheDelegator(object):
     def invalidate(self) -> None:
         self.file_cache.invalidate()
 
+    def invalidate_func(self, func_name: str) -> None:
+        """Invalidate the results of one method (only supported by the 'sqlite' backend)"""
+        self.file_cache.invalidate_func(self.__get_delegate_func(func_name))
+
+    def compact(self) -> None:
+        self.file_cache.compact()
+
+    def flush(self, fsync: Optional[bool]=None) -> None:
+        self.file_cache.flush(fsync)
+
+    def stats(self) -> Dict[str, Dict[str, Union[int, float]]]:
+        return self.file_cache.stats()
+
+    def reset_stats(self) -> None:
+        self.file_cache.reset_stats()
+
+    def exec_batch(self,
+                   func_name: str,
+                   args_list: List[tuple],
+                   executor: Optional[str]=None,
+                   n_workers: Optional[int]=None) -> List[Any]:
+        """Call a method of the object on a list of arguments, only the misses are computed (see
+        `FileCache.exec_batch`). With a 'process' pool, the object is constructed once in each worker process, so
+        `object_constructor` must be picklable.
+        """
+        delegate = self.__get_delegate_func(func_name)
+        if executor != 'process':
+            return self.file_cache.exec_batch(delegate, args_list, executor, n_workers)
+
+        with ProcessPoolExecutor(max_workers=n_workers, initializer=init_worker_object,
+                                 initargs=(self.object_constructor,)) as pool:
+            return self.file_cache.exec_batch(delegate, args_list, pool, n_workers,
+                                              compute=partial(call_worker_object, func_name))
+
     def __get_delegate_func(self, func_name: str) -> Callable[[Any], Any]:
-        def delegate(*args):
+        def delegate(*args, **kwargs):
             if self.object is None:
-                self.object = self.object_constructor()
-            return getattr(self.object, func_name)(*args)
+                with self.object_lock:
+                    if self.object is None:
+                        self.object = self.object_constructor()
+            return getattr(self.object, func_name)(*args, **kwargs)
+        # functions are namespaced by their names only, as the cache belongs to one object
         delegate.__name__ = func_name
+        delegate.__qualname__ = func_name
+        delegate.__module__ = None
 
         return delegate
 
     def __get_exec_func(self, func: Callable[[Any], Any]) -> Callable[[Any], Any]:
-        def exec_func(*args):
-            return self.file_cache.exec_func(func, *args)
+        def exec_func(*args, **kwargs):
+            return self.file_cache.exec_func(func, *args, **kwargs)
 
         return exec_func
 
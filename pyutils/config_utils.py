@@ -1,11 +1,16 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 
+import hashlib
+import itertools
 import os
+import pickle
 import re
 import shutil
+import threading
 from collections import OrderedDict
-from typing import Dict, Iterable, TypeVar, Union
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, TypeVar, Union
 
 import yaml
 
@@ -14,6 +19,9 @@ class RemoteOSPath(object):
 
     # remote path: scheme://[host]:[port]/ or it could be scheme://user@host:port/
     remote_path_reg = re.compile(r'''([a-zA-Z]+://[a-zA-Z0-9:]*)(/.*)?''')
+    # (parent path, child path) => resolved path, only for paths that don't depend on the working directory
+    resolved_paths = {}  # type: Dict[Tuple[str, str], str]
+    max_resolved_paths = 65536
 
     @staticmethod
     def join(parent_path, child_path):
@@ -36,6 +44,25 @@ class RemoteOSPath(object):
             return remote_host + os.path.abspath(remote_path)
         return os.path.abspath(path)
 
+    @staticmethod
+    def is_absolute(path: str) -> bool:
+        """Test if a path is remote or an absolute local path, i.e., it doesn't depend on the working directory"""
+        return os.path.isabs(path) or RemoteOSPath.remote_path_reg.match(path) is not None
+
+    @staticmethod
+    def resolve(parent_path: str, child_path: str) -> str:
+        """Absolute path of a child path relative to a parent path (abspath of join), memoized"""
+        key = (parent_path, child_path)
+        path = RemoteOSPath.resolved_paths.get(key, None)
+        if path is None:
+            joined_path = RemoteOSPath.join(parent_path, child_path)
+            path = RemoteOSPath.abspath(joined_path)
+            if RemoteOSPath.is_absolute(joined_path):
+                if len(RemoteOSPath.resolved_paths) >= RemoteOSPath.max_resolved_paths:
+                    RemoteOSPath.resolved_paths.clear()
+                RemoteOSPath.resolved_paths[key] = path
+        return path
+
 
 class StringConf(str):
     # noinspection PyInitNewSignature,PyTypeChecker
@@ -43,6 +70,8 @@ class StringConf(str):
         # customize the constructor if needed
         obj = super(StringConf, cls).__new__(cls, string)
         obj.__workdir = workdir
+        # the resolved path (see as_path), only kept if it doesn't depend on the working directory
+        obj.__path = None
         return obj
 
     def __add__(self, s: str) -> str:
@@ -54,8 +83,16 @@ class StringConf(str):
     def as_float(self) -> float:
         return float(self)
 
+    def freeze(self) -> 'FrozenStringConf':
+        return freeze_string(self, self.__workdir)
+
     def as_path(self) -> 'StringConf':
-        return StringConf(RemoteOSPath.abspath(RemoteOSPath.join(self.__workdir, self)), self.__workdir)
+        path = self.__path
+        if path is None:
+            path = StringConf(RemoteOSPath.resolve(self.__workdir, self), self.__workdir)
+            if RemoteOSPath.is_absolute(self.__workdir):
+                self.__path = path
+        return path
 
     def ensure_path_existence(self) -> None:
         """Ensure the path existed
@@ -102,6 +139,39 @@ class StringConf(str):
         self.ensure_path_existence()
 
 
+class FrozenStringConf(str):
+    """Read-only StringConf without an instance dict: the workdir is an attribute of the class, there is one
+    subclass per workdir (see `freeze_string`)"""
+    __slots__ = ()
+    workdir = ''
+
+    def __reduce__(self):
+        return freeze_string, (str(self), self.workdir)
+
+    def as_int(self) -> int:
+        return int(self)
+
+    def as_float(self) -> float:
+        return float(self)
+
+    def as_path(self) -> 'FrozenStringConf':
+        return freeze_string(RemoteOSPath.resolve(self.workdir, self), self.workdir)
+
+
+# workdir => subclass of FrozenStringConf
+frozen_string_classes = {}  # type: Dict[str, type]
+
+
+def freeze_string(string: str, workdir: str) -> FrozenStringConf:
+    cls = frozen_string_classes.get(workdir, None)
+    if cls is None:
+        cls = frozen_string_classes[workdir] = type('FrozenStringConf', (FrozenStringConf,), {
+            '__slots__': (),
+            'workdir': workdir
+        })
+    return cls(string)
+
+
 RawPrimitiveType = TypeVar('RawPrimitiveType', int, float, str)
 PrimitiveType = TypeVar('PrimitiveType', int, float, StringConf)
 
@@ -110,15 +180,24 @@ class ListConf(object):
     def __init__(self, array: list, workdir: str) -> None:
         self.array = array
         self.workdir = workdir
+        # configurations whose cached dict contains this list (see `Configuration.to_dict`)
+        self.dependents: Set[Configuration] = set()
 
     def __getitem__(self, item):
         return self.array[item]
 
     def __setitem__(self, item, value):
         self.array[item] = value
+        self.invalidate_dependents()
 
     def __delitem__(self, item):
         del self.array[item]
+        self.invalidate_dependents()
+
+    def invalidate_dependents(self) -> None:
+        dependents, self.dependents = self.dependents, set()
+        for conf in dependents:
+            conf.invalidate_dict()
 
     def __iter__(self):
         return iter(self.array)
@@ -144,9 +223,54 @@ class ListConf(object):
             list_object.append(v)
         return list_object
 
+    def freeze(self) -> 'FrozenListConf':
+        return FrozenListConf(freeze_value(v, self.workdir) for v in self.array)
+
+
+class FrozenListConf(tuple):
+    """Read-only ListConf"""
+    __slots__ = ()
+
+    def to_list(self):
+        return list(self)
+
+    def to_raw_list(self):
+        list_object = []
+        for v in self:
+            if isinstance(v, FrozenConfiguration):
+                v = v.to_dict()
+            elif isinstance(v, FrozenListConf):
+                v = v.to_raw_list()
+            elif isinstance(v, FrozenStringConf):
+                v = str(v)
+            list_object.append(v)
+        return list_object
+
+
+@lru_cache(maxsize=4096)
+def split_dotted_key(key: str) -> Tuple[str, ...]:
+    """Split a dotted key, memoized"""
+    return tuple(key.split('.'))
+
 
 class Configuration(object):
-    def __init__(self, dict_object: Dict[str, Union[RawPrimitiveType, Dict]], workdir: str='', init: bool=True) -> None:
+    # versions of trees of configurations, unique in the process so that a configuration moved to another tree
+    # never matches the version of its previous tree
+    __versions: Iterator[int] = itertools.count()
+
+    def __init__(self, dict_object: Dict[str, Union[RawPrimitiveType, Dict]], workdir: str='', init: bool=True,
+                 lazy: bool=False, layers: Optional[List[Tuple[str, Dict]]]=None,
+                 root: Optional['Configuration']=None, path: str='') -> None:
+        """
+        :param dict_object: raw configuration
+        :param workdir: directory that relative paths are resolved against
+        :param init: resolve the references (only False for children, which are resolved by their root)
+        :param lazy: wrap the children and resolve their references when they are first accessed instead of
+            when the configuration is created
+        :param layers: (source, raw configuration) that dict_object is merged from, in order (see `compose_config`)
+        :param root: root of the tree (only for children, None means this configuration is the root)
+        :param path: dotted key of this configuration in its root, with a trailing dot (only for children)
+        """
         # if __workdir__ is defined in dict_object, it overwrites the bounded workdir
         if '__workdir__' in dict_object:
             workdir = RemoteOSPath.join(workdir, dict_object['__workdir__'])
@@ -154,64 +278,196 @@ class Configuration(object):
         self.__dict_object: Dict = dict_object
         self.__workdir: str = workdir
         self.__conf: OrderedDict[str, Union[PrimitiveType, Configuration]] = OrderedDict()
+        self.__lazy: bool = lazy
+        # keys of the (lazy) children that are still raw values, and the configuration their references point to
+        self.__pending: Set[str] = set()
+        self.__root: Configuration = root if root is not None else self
+        # dotted key of this configuration in its root (with a trailing dot), and the keys of the references that
+        # are being resolved (only used by the root of lazy configurations) to report cycles
+        self.__path: str = path
+        self.__resolving: OrderedDict[str, None] = OrderedDict()
+        # version of the tree (only used by the root), changed on every modification of the tree so that indices
+        # of dotted keys can tell if they are outdated
+        self.__version: int = next(Configuration.__versions)
+        # dotted key => value of the keys that are looked up from this configuration, valid at __index_version
+        self.__index: Dict[str, Union[PrimitiveType, ListConf, Configuration]] = {}
+        self.__index_version: int = self.__version
+        self.__layers: List[Tuple[str, Dict]] = layers if layers is not None else []
+        # plain dict form of this configuration (None if outdated), and the configurations whose cached dict
+        # contains it, i.e. its parents and the configurations referencing it
+        self.__dict_cache: Optional[Dict[str, Union[RawPrimitiveType, Dict]]] = None
+        self.__dependents: Set[Configuration] = set()
 
         for key, value in dict_object.items():
             if key in {'__workdir__'}:
                 continue
 
-            if isinstance(value, (dict, OrderedDict)):
-                self.__conf[key] = Configuration(value, workdir, False)
-            elif isinstance(value, str):
-                self.__conf[key] = StringConf(value, workdir)
-            elif type(value) is list and len(value) > 0:
-                if isinstance(value[0], str):
-                    self.__conf[key] = ListConf([StringConf(x, workdir) for x in value], workdir)
-                elif isinstance(value[0], dict):
-                    self.__conf[key] = ListConf([Configuration(x, workdir, False) for x in value], workdir)
-                else:
-                    self.__conf[key] = value
-            else:
+            if lazy:
                 self.__conf[key] = value
+                self.__pending.add(key)
+            else:
+                self.__conf[key] = self.__wrap(key, value)
 
-        if init:
+        if init and not lazy:
             self.defer_init(self, self)
 
-    def defer_init(self, global_conf: 'Configuration', config: Union[ListConf, 'Configuration']) -> None:
-        """Initialize value in config"""
+    def __wrap(self, key: str, value: Union[RawPrimitiveType, Dict, list]) -> Union[PrimitiveType, ListConf, 'Configuration']:
+        """Wrap a raw value of this configuration, references aren't resolved"""
+        workdir = self.__workdir
+        if isinstance(value, (dict, OrderedDict)):
+            return self.__child(value, workdir, self.__path + key)
+        elif isinstance(value, str):
+            return StringConf(value, workdir)
+        elif type(value) is list and len(value) > 0:
+            if isinstance(value[0], str):
+                return ListConf([StringConf(x, workdir) for x in value], workdir)
+            elif isinstance(value[0], dict):
+                return ListConf([self.__child(x, workdir, '%s%s.%d' % (self.__path, key, i))
+                                 for i, x in enumerate(value)], workdir)
+        return value
+
+    def __child(self, dict_object: Dict, workdir: str, path: str) -> 'Configuration':
+        # the root and path are set before the grandchildren are wrapped, so that they get them right as well
+        return Configuration(dict_object, workdir, False, self.__lazy, root=self.__root, path=path + '.')
+
+    def __get(self, key: str) -> Union[PrimitiveType, ListConf, 'Configuration']:
+        if key in self.__pending:
+            return self.__materialize(key)
+        return self.__conf[key]
+
+    def __materialize(self, key: str) -> Union[PrimitiveType, ListConf, 'Configuration']:
+        """Wrap a lazy child and resolve its references"""
+        value = self.__wrap(key, self.__conf[key])
+        if isinstance(value, (StringConf, ListConf)):
+            path = self.__path + key
+            resolving = self.__root.__resolving
+            if path in resolving:
+                chain = list(resolving)
+                raise ValueError('Cyclic references: %s' % ' -> '.join(chain[chain.index(path):] + [path]))
+            resolving[path] = None
+            try:
+                if isinstance(value, StringConf):
+                    value = self.__resolve_reference(self.__root, value, self.__workdir)
+                else:
+                    # children of the list that are configurations are resolved when they are accessed
+                    for i, item in enumerate(value):
+                        if isinstance(item, StringConf):
+                            value[i] = self.__resolve_reference(self.__root, item, self.__workdir)
+            finally:
+                resolving.popitem()
+
+        self.__conf[key] = value
+        self.__pending.discard(key)
+        return value
+
+    def __materialize_all(self) -> None:
+        if len(self.__pending) > 0:
+            # in declaration order, as the eager mode
+            for key in [key for key in self.__conf if key in self.__pending]:
+                self.__materialize(key)
+
+    @staticmethod
+    def __resolve_reference(global_conf: 'Configuration', value: StringConf,
+                            workdir: str) -> Union[PrimitiveType, ListConf, 'Configuration']:
+        if value.startswith('@@'):
+            # value is a reference to other value as path
+            return global_conf.get_conf(value[2:]).as_path()
+        elif value.startswith('@#'):
+            # value is interpret as path
+            return StringConf(value[2:], workdir).as_path()
+        elif value.startswith('@'):
+            # value is a reference to other value
+            return global_conf.get_conf(value[1:])
+        return value
+
+    def defer_init(self, global_conf: 'Configuration', config: Union[ListConf, 'Configuration'],
+                   path: str='') -> None:
+        """Resolve the references in config against the global configuration.
+
+        References form a dependency graph: a reference depends on the references that its target is looked up
+        through, i.e., the target and its parents (e.g., `@a.b` depends on `a` and `a.b`), including the ones reached
+        through other references (e.g., `@a.b` depends on `c.b` if `a` is `@c`). References are resolved in
+        topological order, so a reference to another reference gets its final value, and each target is looked up
+        once.
+
+        :param global_conf: configuration that the references point to
+        :param config: configuration or list to resolve
+        :param path: dotted key of config in the global configuration
+        """
+        # dotted key of the reference => (container, key or index in the container, reference, workdir)
+        references = OrderedDict()  # type: OrderedDict[str, tuple]
+        self.__collect_references(config, path, references)
+        # (id of container, key or index in the container) => dotted key of the reference
+        slots = {(id(container), slot): ref_key for ref_key, (container, slot, _, _) in references.items()}
+
+        # dotted key => value, for targets and their parents
+        lookups = {'': global_conf}  # type: Dict[str, Union[PrimitiveType, ListConf, Configuration]]
+        resolved = set()  # type: Set[str]
+        # references being resolved, in order (a dict for constant time lookups)
+        resolving = OrderedDict()  # type: OrderedDict[str, None]
+
+        def lookup(key: str) -> Union[PrimitiveType, ListConf, Configuration]:
+            if key not in lookups:
+                parent_key, _, prop = key.rpartition('.')
+                parent = lookup(parent_key)
+                if not isinstance(parent, Configuration):
+                    raise KeyError(key)
+                ref_key = slots.get((id(parent), prop), None)
+                if ref_key is not None:
+                    # the value is a reference, possibly reached through another reference
+                    resolve(ref_key)
+                lookups[key] = parent.__get(prop)
+            return lookups[key]
+
+        def resolve(ref_key: str) -> None:
+            if ref_key in resolved:
+                return
+            if ref_key in resolving:
+                chain = list(resolving)
+                raise ValueError('Cyclic references: %s' % ' -> '.join(chain[chain.index(ref_key):] + [ref_key]))
+
+            container, slot, value, workdir = references[ref_key]
+            if value.startswith('@#'):
+                # value is interpret as path
+                value = StringConf(value[2:], workdir).as_path()
+            else:
+                # value is a reference to other value (as path if it starts with @@)
+                as_path = value.startswith('@@')
+                target = value[2:] if as_path else value[1:]
+                resolving[ref_key] = None
+                value = lookup(target)
+                resolving.popitem()
+                if as_path:
+                    value = value.as_path()
+
+            if isinstance(container, Configuration):
+                container.__conf[slot] = value
+                container.invalidate_dict()
+            else:
+                container[slot] = value
+            lookups[ref_key] = value
+            resolved.add(ref_key)
+
+        for ref_key in references:
+            resolve(ref_key)
+
+    def __collect_references(self, config: Union[ListConf, 'Configuration'], path: str,
+                             references: 'OrderedDict[str, tuple]') -> None:
         if isinstance(config, ListConf):
-            for i, item in enumerate(config):
-                if isinstance(item, StringConf):
-                    if item.startswith('@@'):
-                        # value is a reference to other value as path
-                        item = global_conf.get_conf(item[2:]).as_path()
-                    elif item.startswith('@#'):
-                        # value is interpret as path
-                        item = StringConf(item[2:], config.workdir).as_path()
-                    elif item.startswith('@'):
-                        item = global_conf.get_conf(item[1:])
-                    config[i] = item
-                elif isinstance(item, ListConf):
-                    self.defer_init(global_conf, item)
-                elif isinstance(item, Configuration):
-                    self.defer_init(global_conf, item)
+            items = enumerate(config)
+            workdir = config.workdir
         else:
-            for prop in list(config.__conf.keys()):
-                value = config.__conf[prop]
-                if isinstance(value, StringConf):
-                    if value.startswith('@@'):
-                        # value is a reference to other value as path
-                        value = global_conf.get_conf(value[2:]).as_path()
-                    elif value.startswith('@#'):
-                        # value is interpret as path
-                        value = StringConf(value[2:], config.__workdir).as_path()
-                    elif value.startswith('@'):
-                        # value is a reference to other value
-                        value = global_conf.get_conf(value[1:])
-                    config.__conf[prop] = value
-                elif isinstance(value, ListConf):
-                    self.defer_init(global_conf, value)
-                elif isinstance(value, Configuration):
-                    self.defer_init(global_conf, value)
+            items = config.__conf.items()
+            workdir = config.__workdir
+
+        prefix = path + '.' if path != '' else ''
+        for slot, value in items:
+            key = '%s%s' % (prefix, slot)
+            if isinstance(value, StringConf):
+                if value.startswith('@'):
+                    references[key] = (config, slot, value, workdir)
+            elif isinstance(value, (ListConf, Configuration)):
+                self.__collect_references(value, key, references)
 
     def set_conf(self, key: str, value: RawPrimitiveType, split_key: bool=True) -> 'Configuration':
         if type(value) is dict:
@@ -227,35 +483,97 @@ class Configuration(object):
 
         conf = self
         if split_key:
-            p_keys = key.split('.')
+            p_keys = split_dotted_key(key)
         else:
-            p_keys = [key]
+            p_keys = (key,)
 
         for p_key in p_keys[:-1]:
             assert type(conf) is Configuration, 'Cannot assign property to primitive object'
             if p_key not in conf.__conf:
-                conf.__conf[p_key] = Configuration(OrderedDict(), self.__workdir)
+                conf.__conf[p_key] = conf.__child(OrderedDict(), self.__workdir, conf.__path + p_key)
+                conf.invalidate_dict()
 
-            conf = conf.__conf[p_key]
+            conf = conf.__get(p_key)
 
         assert type(conf) is Configuration, 'Cannot assign property to primitive object'
+        conf.__graft(value, conf.__path + p_keys[-1], set())
         conf.__conf[p_keys[-1]] = value
+        conf.__pending.discard(p_keys[-1])
+        conf.invalidate_dict()
+        self.__root.__version = next(Configuration.__versions)
 
         return self
 
+    def __graft(self, value: Union[PrimitiveType, ListConf, 'Configuration'], path: str, visited: Set[int]) -> None:
+        """Move the configurations of a value assigned to this tree (and their children) to this tree"""
+        if id(value) in visited:
+            return
+        visited.add(id(value))
+        if isinstance(value, Configuration):
+            value.__root = self.__root
+            value.__path = path + '.'
+            for key, child in value.__conf.items():
+                if key not in value.__pending:
+                    self.__graft(child, path + '.' + key, visited)
+        elif isinstance(value, ListConf):
+            for i, item in enumerate(value):
+                self.__graft(item, '%s.%d' % (path, i), visited)
+
     def get_conf(self, key: str) -> Union[PrimitiveType, 'Configuration']:
-        """Get configuration provided by the dot string"""
+        """Get configuration provided by the dot string. Values are indexed by their dotted keys, so that repeated
+        lookups don't walk the tree until a configuration is modified"""
+        version = self.__root.__version
+        if self.__index_version != version:
+            self.__index = {}
+            self.__index_version = version
+        elif key in self.__index:
+            return self.__index[key]
+
+        value = self.__index[key] = self.__walk(split_dotted_key(key))
+        return value
+
+    def get_source(self, key: str) -> Optional[str]:
+        """Source of the value of a dotted key of a composed configuration (the last layer that sets it), None if
+        the key isn't set by any layer"""
+        props = split_dotted_key(self.__path + key)
+        for source, tree in reversed(self.__root.__layers):
+            node = tree
+            for prop in props:
+                if not isinstance(node, dict) or prop not in node:
+                    break
+                node = node[prop]
+            else:
+                return source
+        return None
+
+    def compile_key(self, key: str) -> Callable[[], Union[PrimitiveType, ListConf, 'Configuration']]:
+        """Compile a dotted key into an accessor of its value: the key is split once, and the value is only looked
+        up again after the tree of this configuration is modified"""
+        props = split_dotted_key(key)
+        # version of the tree, value
+        cache = [-1, None]
+
+        def get_value() -> Union[PrimitiveType, ListConf, Configuration]:
+            version = self.__root.__version
+            if cache[0] != version:
+                value = self.__walk(props)
+                cache[0] = version
+                cache[1] = value
+            return cache[1]
+
+        return get_value
+
+    def __walk(self, props: Tuple[str, ...]) -> Union[PrimitiveType, ListConf, 'Configuration']:
         conf = self
-        props = key.split('.')
         for prop in props[:-1]:
-            conf = conf.__conf[prop]
-        return conf.__conf[props[-1]]
+            conf = conf.__get(prop)
+        return conf.__get(props[-1])
 
     def __getattr__(self, name: str) -> Union[PrimitiveType, 'Configuration']:
-        return self.__conf[name]
+        return self.__get(name)
 
     def __getitem__(self, name: str) -> Union[PrimitiveType, 'Configuration']:
-        return self.__conf[name]
+        return self.__get(name)
 
     def __iter__(self) -> Iterable[str]:
         return iter(self.__conf.keys())
@@ -265,55 +583,528 @@ class Configuration(object):
 
     def __delitem__(self, item):
         self.__conf.pop(item)
+        self.__pending.discard(item)
+        self.invalidate_dict()
+        self.__root.__version = next(Configuration.__versions)
 
     def __delattr__(self, item):
         self.__conf.pop(item)
+        self.__pending.discard(item)
+        self.invalidate_dict()
+        self.__root.__version = next(Configuration.__versions)
 
     def as_path(self) -> str:
         return RemoteOSPath.abspath(self.__workdir)
 
     def items(self):
+        self.__materialize_all()
         return self.__conf.items()
 
     def to_dict(self, including_workdir=False) -> Dict[str, Union[RawPrimitiveType, Dict]]:
+        """Plain dict form of this configuration, a copy of `to_cached_dict` that can be modified"""
         dict_object = {}
         if including_workdir:
             dict_object['__workdir__'] = self.__workdir
+        dict_object.update(copy_tree(self.to_cached_dict()))
+        return dict_object
+
+    def to_cached_dict(self) -> Dict[str, Union[RawPrimitiveType, Dict]]:
+        """Plain dict form of this configuration. It is cached until the configuration or one of its children is
+        modified (by `set_conf`, deletion or assignment to a list), so the returned dict is shared between calls
+        and must not be modified (use `to_dict` to get a copy)"""
+        if self.__dict_cache is None:
+            self.__dict_cache = self.__build_dict()
+        return self.__dict_cache
 
+    def __build_dict(self) -> Dict[str, Union[RawPrimitiveType, Dict]]:
+        dict_object = {}
+        self.__materialize_all()
         for k, v in self.__conf.items():
             if isinstance(v, Configuration):
-                v = v.to_dict()
+                v.__dependents.add(self)
+                v = v.to_cached_dict()
             elif isinstance(v, ListConf):
+                v.dependents.add(self)
+                for item in v:
+                    if isinstance(item, Configuration):
+                        item.__dependents.add(self)
                 v = v.to_raw_list()
             elif isinstance(v, StringConf):
                 v = str(v)
             dict_object[k] = v
         return dict_object
 
+    def invalidate_dict(self) -> None:
+        """Drop the cached dict form of this configuration and of the configurations containing it"""
+        if self.__dict_cache is None:
+            # the configurations containing it have been invalidated already
+            return
+        self.__dict_cache = None
+        dependents, self.__dependents = self.__dependents, set()
+        for conf in dependents:
+            conf.invalidate_dict()
+
     def to_raw_dict(self):
         return self.__dict_object
 
+    def freeze(self) -> 'FrozenConfiguration':
+        """Read-only and hashable copy of this configuration (references are resolved)"""
+        return FrozenConfiguration(
+            OrderedDict((key, freeze_value(value, self.__workdir)) for key, value in self.items()), self.__workdir)
+
+    def reload_from(self, config: 'Configuration') -> List[str]:
+        """Update this configuration to another one (e.g., the same file loaded again): only the subtrees that
+        changed are replaced by the ones of the other configuration, objects of the other subtrees are kept.
+
+        :return: dotted keys of the replaced, added or deleted subtrees
+        """
+        # keys of the changes are kept as tuples, since keys may contain dots (e.g., names of loggers)
+        changes = []  # type: List[Tuple[str, ...]]
+        self.__diff(self, config, (), changes)
+        for key in changes:
+            parent, new_parent = self, config
+            for name in key[:-1]:
+                parent, new_parent = parent[name], new_parent[name]
+            prop = key[-1]
+            if prop in new_parent:
+                parent.set_conf(prop, new_parent[prop], split_key=False)
+            else:
+                del parent[prop]
+        self.__dict_object = config.__dict_object
+        return ['.'.join(key) for key in changes]
+
+    @staticmethod
+    def __diff(old: 'Configuration', new: 'Configuration', path: Tuple[str, ...],
+               changes: List[Tuple[str, ...]]) -> None:
+        new_items = OrderedDict(new.items())
+        for key, old_value in old.items():
+            if key not in new_items:
+                changes.append(path + (key,))
+                continue
+
+            new_value = new_items[key]
+            if isinstance(old_value, Configuration) and isinstance(new_value, Configuration) and \
+                    old_value.__workdir == new_value.__workdir:
+                Configuration.__diff(old_value, new_value, path + (key,), changes)
+            elif not Configuration.__is_same(old_value, new_value):
+                changes.append(path + (key,))
+        for key in new_items:
+            if key not in old:
+                changes.append(path + (key,))
+
+    @staticmethod
+    def __is_same(old: Union[PrimitiveType, ListConf, 'Configuration'],
+                  new: Union[PrimitiveType, ListConf, 'Configuration']) -> bool:
+        """Test if two values are the same, including the paths they resolve to"""
+        if type(old) is not type(new):
+            return False
+        if isinstance(old, Configuration):
+            return old.__workdir == new.__workdir and old.to_cached_dict() == new.to_cached_dict()
+        if isinstance(old, ListConf):
+            return old.workdir == new.workdir and old.to_raw_list() == new.to_raw_list()
+        if isinstance(old, StringConf):
+            return old == new and old.as_path() == new.as_path()
+        return old == new
+
+
+class FrozenConfiguration(object):
+    """Read-only configuration made by `Configuration.freeze`. It doesn't keep the raw configuration, its nodes
+    have no instance dict, and its hash is computed once from its structure (so it can be a key of caches).
+    Lists are tuples (FrozenListConf) and strings are FrozenStringConf.
+
+    A digest that is stable across processes is also computed once (from the digests of the children), it's the
+    key of the configuration for the caches of `cache_utils` (`__cache_key__`), which don't walk the tree then."""
+    __slots__ = ('__conf', '__workdir', '__hash', '__digest')
+
+    def __init__(self, conf: Dict[str, Any], workdir: str) -> None:
+        object.__setattr__(self, '_FrozenConfiguration__conf', conf)
+        object.__setattr__(self, '_FrozenConfiguration__workdir', workdir)
+        object.__setattr__(self, '_FrozenConfiguration__hash', hash((workdir, tuple(conf.items()))))
+        algo = hashlib.blake2b(digest_size=16)
+        algo.update(repr(workdir).encode('utf-8'))
+        for key, value in conf.items():
+            algo.update(repr(key).encode('utf-8'))
+            FrozenConfiguration.__update_digest(algo, value)
+        object.__setattr__(self, '_FrozenConfiguration__digest', algo.hexdigest())
+
+    @staticmethod
+    def __update_digest(algo: Any, value: Any) -> None:
+        if isinstance(value, FrozenConfiguration):
+            algo.update(b'c' + value.__digest.encode('ascii'))
+        elif isinstance(value, FrozenListConf):
+            algo.update(b'l%d:' % len(value))
+            for item in value:
+                FrozenConfiguration.__update_digest(algo, item)
+        elif isinstance(value, FrozenStringConf):
+            algo.update(b's' + repr((str(value), value.workdir)).encode('utf-8'))
+        else:
+            algo.update(b'v' + repr((type(value).__name__, value)).encode('utf-8'))
+
+    def __reduce__(self):
+        return FrozenConfiguration, (self.__conf, self.__workdir)
+
+    def __cache_key__(self) -> str:
+        return self.__digest
+
+    def __hash__(self) -> int:
+        return self.__hash
+
+    def __eq__(self, other: Any) -> bool:
+        if self is other:
+            return True
+        if not isinstance(other, FrozenConfiguration) or self.__hash != other.__hash:
+            return False
+        return self.__workdir == other.__workdir and list(self.__conf.items()) == list(other.__conf.items())
+
+    def __ne__(self, other: Any) -> bool:
+        return not self.__eq__(other)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise TypeError('FrozenConfiguration is read-only')
+
+    def __delattr__(self, name: str) -> None:
+        raise TypeError('FrozenConfiguration is read-only')
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            return self.__conf[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, name: str) -> Any:
+        return self.__conf[name]
+
+    def __iter__(self) -> Iterable[str]:
+        return iter(self.__conf.keys())
 
-def load_config(fpath: str) -> Configuration:
-    # load yaml with OrderedDict to preserve order
-    # http://stackoverflow.com/questions/5121931/in-python-how-can-you-load-yaml-mappings-as-ordereddicts
-    def load_yaml_file(file_stream):
-        def ordered_load(stream, Loader=yaml.Loader, object_pairs_hook=OrderedDict):
-            class OrderedLoader(Loader):
-                pass
+    def __contains__(self, item: str) -> bool:
+        return item in self.__conf
 
-            def construct_mapping(loader, node):
-                loader.flatten_mapping(node)
-                return object_pairs_hook(loader.construct_pairs(node))
+    def __len__(self) -> int:
+        return len(self.__conf)
 
-            OrderedLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, construct_mapping)
-            return yaml.load(stream, OrderedLoader)
+    def get_conf(self, key: str) -> Any:
+        conf = self
+        for prop in split_dotted_key(key):
+            conf = conf.__conf[prop]
+        return conf
 
-        # noinspection PyTypeChecker
-        return ordered_load(file_stream, yaml.SafeLoader)
+    def as_path(self) -> str:
+        return RemoteOSPath.abspath(self.__workdir)
 
-    with open(fpath, 'r') as f:
-        return Configuration(load_yaml_file(f), workdir=os.path.dirname(fpath))
+    def items(self):
+        return self.__conf.items()
+
+    def to_dict(self) -> Dict[str, Union[RawPrimitiveType, Dict]]:
+        dict_object = {}
+        for k, v in self.__conf.items():
+            if isinstance(v, FrozenConfiguration):
+                v = v.to_dict()
+            elif isinstance(v, FrozenListConf):
+                v = v.to_raw_list()
+            elif isinstance(v, FrozenStringConf):
+                v = str(v)
+            dict_object[k] = v
+        return dict_object
+
+
+def copy_tree(value: Any) -> Any:
+    """Copy the dicts and lists of a plain tree (e.g., `Configuration.to_cached_dict`), other values are shared"""
+    if isinstance(value, dict):
+        return {k: copy_tree(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [copy_tree(v) for v in value]
+    return value
+
+
+def freeze_value(value: Any, workdir: str) -> Any:
+    """Read-only and hashable copy of a value of a configuration"""
+    if isinstance(value, (Configuration, ListConf, StringConf)):
+        return value.freeze()
+    if isinstance(value, (list, tuple)):
+        return FrozenListConf(freeze_value(v, workdir) for v in value)
+    if isinstance(value, dict):
+        return FrozenConfiguration(
+            OrderedDict((k, freeze_value(v, workdir)) for k, v in value.items() if k != '__workdir__'), workdir)
+    if isinstance(value, str):
+        return freeze_string(value, workdir)
+    return value
+
+
+class ConfigWatcher(object):
+    """Poll a configuration file and reload the configuration loaded from it when the file is modified. Only the
+    changed subtrees are replaced (see `Configuration.reload_from`), and the callbacks of the changed dotted keys
+    are called with the list of changes.
+
+    A file that can't be parsed (e.g., it's being written) is retried at the next poll, the error is kept in
+    `error`. So are the errors raised by the reloads or the callbacks in the polling thread.
+    """
+
+    def __init__(self, config: Configuration, fpath: str, interval: float=1.0, lazy: bool=False,
+                 snapshot_dir: Optional[str]=None) -> None:
+        """
+        :param config: the configuration loaded from the file, updated in place
+        :param fpath: path of the file
+        :param interval: seconds between two polls
+        :param lazy: options of `load_config` to load the file again
+        :param snapshot_dir: options of `load_config` to load the file again
+        """
+        self.config = config
+        self.fpath = fpath
+        self.interval = interval
+        self.lazy = lazy
+        self.snapshot_dir = snapshot_dir
+        # dotted key => callbacks, the empty key is the whole configuration
+        self.callbacks = OrderedDict()  # type: OrderedDict[str, List[Callable[[List[str]], None]]]
+        self.error = None  # type: Optional[Exception]
+        self.stat = self.__stat()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None  # type: Optional[threading.Thread]
+
+    def on_change(self, key: str, callback: Callable[[List[str]], None]) -> 'ConfigWatcher':
+        """Register a callback of a dotted key, it's called with the changes of the key, of its children or of its
+        parents"""
+        self.callbacks.setdefault(key, []).append(callback)
+        return self
+
+    def check(self) -> List[str]:
+        """Reload the configuration if the file is modified, return the dotted keys of the changes"""
+        with self.lock:
+            stat = self.__stat()
+            if stat == self.stat:
+                return []
+            try:
+                config = load_config(self.fpath, self.lazy, self.snapshot_dir)
+            except (OSError, yaml.YAMLError, ValueError, KeyError) as e:
+                self.error = e
+                return []
+
+            changes = self.config.reload_from(config)
+            # only a successful reload is recorded, otherwise the file is loaded again at the next check
+            self.stat = stat
+            self.error = None
+
+        for key, callbacks in self.callbacks.items():
+            key_changes = [change for change in changes
+                           if key == '' or change == key or change.startswith(key + '.') or
+                           key.startswith(change + '.')]
+            if len(key_changes) > 0:
+                for callback in callbacks:
+                    callback(key_changes)
+        return changes
+
+    def start(self) -> 'ConfigWatcher':
+        """Poll the file in a background thread"""
+        assert self.thread is None, 'The watcher is already started'
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.__poll, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            self.thread = None
+
+    def __poll(self) -> None:
+        while not self.stopped.wait(self.interval):
+            try:
+                self.check()
+            except Exception as e:
+                # errors of reloads or callbacks don't stop the polling
+                self.error = e
+
+    def __stat(self) -> Optional[Tuple[int, int]]:
+        try:
+            stat = os.stat(self.fpath)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+
+# load yaml with OrderedDict to preserve order, using the C loader (libyaml) if it's available
+# http://stackoverflow.com/questions/5121931/in-python-how-can-you-load-yaml-mappings-as-ordereddicts
+class OrderedLoader(getattr(yaml, 'CSafeLoader', yaml.SafeLoader)):
+    pass
+
+
+def construct_mapping(loader, node):
+    loader.flatten_mapping(node)
+    return OrderedDict(loader.construct_pairs(node))
+
+
+OrderedLoader.add_constructor(yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, construct_mapping)
+
+# version of the format of snapshots, snapshots of other versions are ignored
+SNAPSHOT_VERSION = 1
+# errors of unpickling snapshots that are corrupted or written by another interpreter, they are parsed again
+SNAPSHOT_ERRORS = (pickle.UnpicklingError, EOFError, ValueError, AttributeError, ImportError, IndexError, KeyError,
+                   TypeError)
+
+
+def get_snapshot_fpath(fpath: str, snapshot_dir: str) -> str:
+    return os.path.join(snapshot_dir, hashlib.blake2b(os.path.abspath(fpath).encode('utf-8'),
+                                                      digest_size=16).hexdigest() + '.pkl')
+
+
+def load_yaml(fpath: str, snapshot_dir: Optional[str]=None) -> Dict:
+    """Parse a YAML file, mappings are OrderedDict.
+
+    If `snapshot_dir` is set, the parsed tree is also stored there in a pickled snapshot, which is reused as long as
+    the file has the same mtime and size, or the same content. A snapshot that can't be read (e.g., corrupted) is
+    replaced. Snapshots are trusted (pickle), so the directory must only be writable by the user.
+    """
+    if snapshot_dir is None:
+        with open(fpath, 'rb') as f:
+            return yaml.load(f, OrderedLoader)
+
+    stat = os.stat(fpath)
+    snapshot_fpath = get_snapshot_fpath(fpath, snapshot_dir)
+    header = None
+    if os.path.exists(snapshot_fpath):
+        try:
+            with open(snapshot_fpath, 'rb') as f:
+                # the header is a separated pickle so that the tree isn't unpickled if the snapshot is outdated
+                header = pickle.load(f)
+                if not isinstance(header, tuple) or len(header) != 5:
+                    header = None
+                elif header[:4] == (SNAPSHOT_VERSION, os.path.abspath(fpath), stat.st_mtime_ns, stat.st_size):
+                    return pickle.load(f)
+        except SNAPSHOT_ERRORS:
+            header = None
+
+    with open(fpath, 'rb') as f:
+        content = f.read()
+    digest = hashlib.blake2b(content).hexdigest()
+    is_parsed = False
+    if header is not None and header[0] == SNAPSHOT_VERSION and header[4] == digest:
+        # the file is touched but not modified
+        try:
+            with open(snapshot_fpath, 'rb') as f:
+                pickle.load(f)
+                tree = pickle.load(f)
+                is_parsed = True
+        except SNAPSHOT_ERRORS:
+            pass
+    if not is_parsed:
+        tree = yaml.load(content, OrderedLoader)
+
+    if not os.path.exists(snapshot_dir):
+        os.makedirs(snapshot_dir, exist_ok=True)
+    # write to a temporary file then rename it, so that concurrent loaders never read a partial snapshot
+    tmp_fpath = '%s.%d.tmp' % (snapshot_fpath, os.getpid())
+    with open(tmp_fpath, 'wb') as f:
+        pickle.dump((SNAPSHOT_VERSION, os.path.abspath(fpath), stat.st_mtime_ns, stat.st_size, digest), f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(tree, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_fpath, snapshot_fpath)
+    return tree
+
+
+def load_config(fpath: str, lazy: bool=False, snapshot_dir: Optional[str]=None) -> Configuration:
+    """Load a YAML configuration file
+
+    :param fpath: path of the file
+    :param lazy: see Configuration
+    :param snapshot_dir: directory of the parsed files (see `load_yaml`), files are always parsed if None
+    """
+    return Configuration(load_yaml(fpath, snapshot_dir), workdir=os.path.dirname(fpath), lazy=lazy)
+
+
+def merge_trees(base: Dict, overlay: Dict) -> Dict:
+    """Merge a raw configuration into another one: mappings are merged recursively, other values of the overlay
+    replace the ones of the base. Only the mappings that the overlay changes are copied (shallowly), the other
+    subtrees are shared with the inputs."""
+    merged = OrderedDict(base)
+    for key, value in overlay.items():
+        base_value = merged.get(key, None)
+        if isinstance(base_value, dict) and isinstance(value, dict):
+            merged[key] = merge_trees(base_value, value)
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_layers(fpath: str, snapshot_dir: Optional[str]=None, including: Tuple[str, ...]=()) -> List[Tuple[str, Dict]]:
+    """Load a YAML file and the files it includes (`__include__: path or list of paths` at its top level, relative
+    to the file) as layers: the included files come first, in order, then the file itself"""
+    fpath = os.path.abspath(fpath)
+    if fpath in including:
+        raise ValueError('Cyclic includes: %s' % ' -> '.join(including[including.index(fpath):] + (fpath,)))
+
+    tree = load_yaml(fpath, snapshot_dir)
+    if not isinstance(tree, dict) or '__include__' not in tree:
+        return [(fpath, tree)]
+
+    includes = tree['__include__']
+    layers = []
+    for include in [includes] if isinstance(includes, str) else includes:
+        layers += load_layers(os.path.join(os.path.dirname(fpath), include), snapshot_dir, including + (fpath,))
+    layers.append((fpath, OrderedDict((key, value) for key, value in tree.items() if key != '__include__')))
+    return layers
+
+
+def get_env_layers(env_prefix: str, environ: Optional[Dict[str, str]]=None) -> List[Tuple[str, Dict]]:
+    """Layers of the environment variables that start with the prefix: the rest of the name is the key of the
+    value, with `__` separating the levels (e.g., APP__DATA__GOLD sets data.gold when the prefix is APP__). Keys
+    are lower-cased, values are parsed as YAML scalars (strings if they can't be parsed)."""
+    environ = environ if environ is not None else os.environ
+    layers = []
+    for name in sorted(environ):
+        if not name.startswith(env_prefix) or len(name) == len(env_prefix):
+            continue
+        try:
+            value = yaml.load(environ[name], OrderedLoader)
+        except yaml.YAMLError:
+            value = environ[name]
+
+        props = name[len(env_prefix):].lower().split('__')
+        tree = OrderedDict()  # type: Dict
+        node = tree
+        for prop in props[:-1]:
+            node[prop] = OrderedDict()
+            node = node[prop]
+        node[props[-1]] = value
+        layers.append(('env:' + name, tree))
+    return layers
+
+
+def compose_config(fpaths: List[str],
+                   env_prefix: Optional[str]=None,
+                   environ: Optional[Dict[str, str]]=None,
+                   ignore_missing: bool=False,
+                   lazy: bool=False,
+                   snapshot_dir: Optional[str]=None) -> Configuration:
+    """Compose a configuration from layers: YAML files (with their includes) in order (e.g., base, environment,
+    host), then environment variables. Later layers override earlier ones, mappings are merged (see
+    `merge_trees`). The source of each value is given by `Configuration.get_source`.
+
+    Relative paths are resolved against the directory of the first file (unless `__workdir__` is set).
+
+    :param fpaths: YAML files, in order
+    :param env_prefix: prefix of the environment variables that override values (see `get_env_layers`), not
+        used if None
+    :param environ: environment variables, default is os.environ
+    :param ignore_missing: skip files that don't exist (e.g., optional host files)
+    :param lazy: see Configuration
+    :param snapshot_dir: see `load_yaml`
+    """
+    layers = []  # type: List[Tuple[str, Dict]]
+    for fpath in fpaths:
+        if ignore_missing and not os.path.exists(fpath):
+            continue
+        layers += load_layers(fpath, snapshot_dir)
+    if env_prefix is not None:
+        layers += get_env_layers(env_prefix, environ)
+
+    tree = OrderedDict()  # type: Dict
+    for source, layer in layers:
+        tree = merge_trees(tree, layer)
+    return Configuration(tree, workdir=os.path.dirname(fpaths[0]), lazy=lazy, layers=layers)
 
 
 def write_config(config: Configuration, fpath: str) -> None:
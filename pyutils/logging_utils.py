@@ -219,7 +219,8 @@ class Logger(object):
         if name in self.loggers:
             return logging.getLogger(name)
 
-        dict_config = self.config.logging.to_dict()
+        # shared with the configuration, dict_configurator copies the parts that it modifies
+        dict_config = self.config.logging.to_cached_dict()
 
         ns_hierarchy = name.split(".")
         config_name = name
@@ -1,11 +1,18 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
+import asyncio
+import multiprocessing
 import os
+import subprocess
+import sys
 import time
 
+import numpy as np
+
 from nose.tools import *
 
-from pyutils.cache_utils import Cache, FileCache, FileCacheDelegator
+from pyutils.cache_utils import BinaryCodec, Cache, FileCache, FileCacheDelegator, HashKeyBuilder, JsonKeyBuilder, \
+    ShardedFileCache, SharedMemoryCache, SqliteFileCache, TieredCache
 
 
 class Counter(object):
@@ -22,6 +29,10 @@ class Counter(object):
     def reduce(self, a, b):
         return a - b
 
+    async def async_increase(self, message):
+        await asyncio.sleep(0.01)
+        return self.increase(message)
+
 
 def test_memory_cache():
     cache = Cache()
@@ -40,6 +51,54 @@ def test_memory_cache():
     eq_(mess, 'messB')
 
 
+def test_memory_cache_lru():
+    cache = Cache(max_size=2, eviction='lru')
+    counter = Counter()
+
+    cache.exec_func(counter.increase, 'messA')
+    cache.exec_func(counter.increase, 'messB')
+    cache.exec_func(counter.increase, 'messA')
+    cache.exec_func(counter.increase, 'messC')
+    eq_(counter.count, 3)
+    eq_(len(cache.data[cache.key_builder.namespace(counter.increase)]), 2, 'Cache is bounded')
+
+    count, mess = cache.exec_func(counter.increase, 'messA')
+    eq_(count, 1, 'Recently used entry is kept')
+    count, mess = cache.exec_func(counter.increase, 'messB')
+    eq_(count, 4, 'Least recently used entry is evicted')
+
+
+def test_memory_cache_lfu():
+    cache = Cache(max_size=2, eviction='lfu')
+    counter = Counter()
+
+    cache.exec_func(counter.increase, 'messA')
+    cache.exec_func(counter.increase, 'messA')
+    cache.exec_func(counter.increase, 'messB')
+    cache.exec_func(counter.increase, 'messC')
+    eq_(counter.count, 3)
+
+    count, mess = cache.exec_func(counter.increase, 'messA')
+    eq_(count, 1, 'Frequently used entry is kept')
+    count, mess = cache.exec_func(counter.increase, 'messB')
+    eq_(count, 4, 'Least frequently used entry is evicted')
+
+
+def test_memory_cache_max_bytes():
+    # the size of a value is the length of its message
+    cache = Cache(max_bytes=100, sizeof=lambda value: len(value[1]))
+    counter = Counter()
+
+    cache.exec_func(counter.increase, 'a' * 60)
+    cache.exec_func(counter.increase, 'b' * 60)
+    namespace = cache.key_builder.namespace(counter.increase)
+    eq_(list(cache.data[namespace].keys()), [cache.key_builder.key(('b' * 60,), {})], 'Budget is respected')
+    eq_(cache.nbytes[namespace], 60)
+
+    cache.clear_func(counter.increase)
+    ok_(namespace not in cache.data)
+
+
 def test_file_cache():
     timeid = time.time()
     cache_file = f'/tmp/file_cache_{timeid}.txt'
@@ -144,3 +203,572 @@ def test_cache_delegator_must_context():
     cache = FileCacheDelegator(cache_file, create_counter)
     cache.load_data()
     cache.exec_func(counter.increase, 'messA')
+
+
+def test_file_cache_compact_and_index():
+    timeid = time.time()
+    cache_file = f'/tmp/file_cache_{timeid}.txt'
+    ok_(not os.path.exists(cache_file))
+
+    counter = Counter()
+    # write the same keys twice because the data are not loaded
+    for _ in range(2):
+        cache = FileCache(cache_file)
+        with cache:
+            cache.exec_func(counter.increase, 'messA')
+            cache.exec_func(counter.increase, 'messB')
+    with open(cache_file, 'r') as f:
+        eq_(len(f.readlines()), 4)
+
+    cache = FileCache(cache_file)
+    cache.compact()
+    with open(cache_file, 'r') as f:
+        eq_(len(f.readlines()), 2, 'Superseded records are removed')
+    ok_(os.path.exists(cache_file + '.idx'), 'Index is written')
+
+    counter = Counter()
+    cache = FileCache(cache_file)
+    cache.load_data()
+    with cache:
+        count, mess = cache.exec_func(counter.increase, 'messB')
+        eq_(count, 4, 'Latest record is kept')
+        count, mess = cache.exec_func(counter.increase, 'messC')
+        eq_(count, 1, 'Increase func is called')
+        cache.compact()
+        count, mess = cache.exec_func(counter.increase, 'messD')
+
+    # reload from the index and the records appended after it
+    counter = Counter()
+    cache = FileCache(cache_file)
+    cache.load_data()
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messA'), [3, 'messA'])
+        eq_(cache.exec_func(counter.increase, 'messC'), [1, 'messC'])
+        eq_(cache.exec_func(counter.increase, 'messD'), [2, 'messD'])
+        eq_(counter.count, 0, 'Increase func is not called')
+
+    # records appended by another cache between loading and entering the context are indexed
+    cache_file = f'/tmp/file_cache_{timeid}_2.txt'
+    counter = Counter()
+    cache_a, cache_b = FileCache(cache_file), FileCache(cache_file)
+    cache_a.load_data()
+    cache_b.load_data()
+    with cache_b:
+        cache_b.exec_func(counter.increase, 'messA')
+    with cache_a:
+        cache_a.exec_func(counter.increase, 'messB')
+    cache = FileCache(cache_file)
+    cache.load_data()
+    eq_(sorted(cache.data.values()), [[1, 'messA'], [2, 'messB']])
+
+    # an index of a replaced log is ignored
+    with open(cache_file, 'r') as f:
+        content = f.read()
+    os.replace(cache_file, cache_file + '.old')
+    with open(cache_file, 'w') as f:
+        f.write(content * 2)
+    cache = FileCache(cache_file, lazy=True)
+    cache.load_data()
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messB'), [2, 'messB'])
+        eq_(counter.count, 2, 'Increase func is not called')
+
+
+def test_file_cache_lazy():
+    timeid = time.time()
+    cache_file = f'/tmp/file_cache_{timeid}.txt'
+    ok_(not os.path.exists(cache_file))
+
+    counter = Counter()
+    cache = FileCache(cache_file, lazy=True)
+    cache.load_data()
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messA'), (1, 'messA'))
+        eq_(cache.exec_func(counter.increase, 'messA'), [1, 'messA'], 'Value is read back from the log')
+        eq_(cache.exec_func(counter.increase, 'messB'), (2, 'messB'))
+        eq_(counter.count, 2)
+        eq_(len(cache.data), 0, 'Values are not kept in memory')
+
+    counter = Counter()
+    cache = FileCache(cache_file, lazy=True, hot_size=1)
+    cache.load_data()
+    eq_(len(cache.data), 0, 'Only keys are loaded')
+    eq_(len(cache.offsets), 2)
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messB'), [2, 'messB'])
+        eq_(cache.exec_func(counter.increase, 'messA'), [1, 'messA'])
+        eq_(list(cache.hot.keys()), [cache.get_key(counter.increase, ('messA',), {})], 'Hot values are bounded')
+        eq_(counter.count, 0, 'Increase func is not called')
+
+    counter = Counter()
+    cache = FileCache(cache_file, lazy=True)
+    cache.load_data()
+    key_a, key_b = [cache.get_key(counter.increase, (mess,), {}) for mess in ['messA', 'messB']]
+    cache.offsets[key_a] = cache.offsets[key_b]
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messA'), (1, 'messA'), 'Record of another key is a miss')
+
+
+def test_file_cache_concurrent():
+    timeid = time.time()
+    cache_file = f'/tmp/file_cache_{timeid}.txt'
+    ok_(not os.path.exists(cache_file))
+
+    counter_a, counter_b = Counter(), Counter()
+    cache_a = FileCache(cache_file, concurrent=True)
+    cache_b = FileCache(cache_file, concurrent=True, lazy=True)
+    cache_a.load_data()
+    cache_b.load_data()
+    with cache_a, cache_b:
+        eq_(cache_a.exec_func(counter_a.increase, 'messA'), (1, 'messA'))
+        eq_(cache_b.exec_func(counter_b.increase, 'messA'), [1, 'messA'], 'Record of the other writer is read')
+        eq_(counter_b.count, 0, 'Increase func is not called')
+
+        eq_(cache_b.exec_func(counter_b.increase, 'messB'), (1, 'messB'))
+        eq_(cache_a.exec_func(counter_a.increase, 'messB'), [1, 'messB'])
+        eq_(counter_a.count, 1)
+
+        # compaction by one writer is noticed by the other
+        cache_a.compact()
+        eq_(cache_b.exec_func(counter_b.increase, 'messC'), (2, 'messC'))
+        eq_(cache_a.exec_func(counter_a.increase, 'messC'), [2, 'messC'])
+        eq_(counter_a.count, 1)
+
+    with open(cache_file, 'r') as f:
+        eq_(len(f.readlines()), 3, 'Records are not interleaved')
+
+
+def test_async_cache():
+    timeid = time.time()
+    cache_file = f'/tmp/file_cache_{timeid}.txt'
+    ok_(not os.path.exists(cache_file))
+
+    async def run(cache):
+        counter = Counter()
+        results = await asyncio.gather(*[
+            cache.async_exec_func(counter.async_increase, mess)
+            for mess in ['messA', 'messA', 'messB', 'messA']
+        ])
+        eq_(results, [(1, 'messA'), (1, 'messA'), (2, 'messB'), (1, 'messA')])
+        eq_(counter.count, 2, 'Concurrent calls on the same key share one computation')
+        eq_(await cache.async_exec_func(counter.async_increase, 'messB'), (2, 'messB'))
+        eq_(counter.count, 2, 'Increase func is not called')
+
+    asyncio.run(run(Cache()))
+
+    cache = FileCache(cache_file)
+    with cache:
+        asyncio.run(run(cache))
+
+
+def test_file_cache_group_commit():
+    timeid = time.time()
+    cache_file = f'/tmp/file_cache_{timeid}.txt'
+    ok_(not os.path.exists(cache_file))
+
+    def n_records():
+        with open(cache_file, 'r') as f:
+            return len(f.readlines())
+
+    counter = Counter()
+    cache = FileCache(cache_file, lazy=True, flush_every=2)
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messA'), (1, 'messA'))
+        eq_(n_records(), 0, 'Record is buffered')
+        eq_(cache.exec_func(counter.increase, 'messA'), (1, 'messA'), 'Buffered record is a hit')
+        cache.exec_func(counter.increase, 'messB')
+        eq_(n_records(), 2, 'Records are written together')
+        cache.exec_func(counter.increase, 'messC')
+        cache.flush(fsync=True)
+        eq_(n_records(), 3, 'Records are written on flush')
+        cache.exec_func(counter.increase, 'messD')
+    eq_(n_records(), 4, 'Records are written on exit')
+    eq_(counter.count, 4)
+
+    cache = FileCache(cache_file, flush_interval=10)
+    cache.load_data()
+    with cache:
+        cache.exec_func(counter.increase, 'messE')
+        eq_(n_records(), 4, 'Record is buffered')
+        time.sleep(0.1)
+        eq_(n_records(), 5, 'Records are written after the interval')
+
+
+def test_key_builder():
+    key_builder = HashKeyBuilder()
+    eq_(key_builder.namespace(Counter.increase), 'tests.pyutils.test_cache_utils.Counter.increase')
+    eq_(key_builder.key(('messA', 1), {}), "('messA', 1)", 'Short primitive arguments are used as is')
+    ok_(key_builder.key((1,), {}) != key_builder.key((1.0,), {}) != key_builder.key((True,), {}))
+    eq_(len(key_builder.key(('a' * 100,), {})), 32, 'Long arguments are hashed')
+
+    array = np.arange(12, dtype=np.float64).reshape((3, 4))
+    eq_(key_builder.key((array,), {'b': {1, 2}, 'a': None}), key_builder.key((array.copy(),), {'a': None, 'b': {2, 1}}))
+    ok_(key_builder.key((array,), {}) != key_builder.key((array.T,), {}))
+    ok_(key_builder.key((array,), {}) != key_builder.key((array.astype(np.float32),), {}))
+
+    # objects are hashed by their states, whose sets don't depend on the hash seed of the process
+    script = 'from pyutils.cache_utils import stable_hash\n' \
+             'class Tags(object):\n' \
+             '    def __init__(self):\n' \
+             '        self.tags = {"messA", "messB", "messC", "messD"}\n' \
+             'print(stable_hash(Tags()))'
+    digests = {subprocess.run([sys.executable, '-c', script], env=dict(os.environ, PYTHONHASHSEED=str(seed)),
+                              stdout=subprocess.PIPE, check=True).stdout for seed in range(3)}
+    eq_(len(digests), 1)
+
+    eq_(JsonKeyBuilder().key(('messA',), {}), '["messA"]')
+
+    cache = Cache()
+    counter = Counter()
+    eq_(cache.exec_func(counter.sum, 5, b=6), 11, 'Keyword arguments are supported')
+    eq_(cache.exec_func(counter.sum, 5, 7), 12, 'Keyword arguments are part of the key')
+    eq_(cache.exec_func(counter.increase, {'messA'}), (1, {'messA'}))
+    eq_(cache.exec_func(counter.increase, {'messA'}), (1, {'messA'}))
+
+    # closures of the same definition are different if they capture different values
+    def adder(n):
+        return lambda x: x + n
+
+    def apply(func, x):
+        return func(x)
+
+    eq_(cache.exec_func(apply, adder(1), 1), 2)
+    eq_(cache.exec_func(apply, adder(100), 1), 101)
+    eq_(key_builder.key((adder(1),), {}), key_builder.key((adder(1),), {}))
+
+
+def test_file_cache_previous_keys():
+    timeid = time.time()
+    cache_file = f'/tmp/file_cache_{timeid}.txt'
+    ok_(not os.path.exists(cache_file))
+
+    # log written by previous versions: JSON keys and no timestamps
+    with open(cache_file, 'w') as f:
+        f.write('["increase:[\\"messA\\"]", [1, "messA"]]\n')
+    counter = Counter()
+    cache = FileCache(cache_file)
+    ok_(isinstance(cache.key_builder, JsonKeyBuilder), 'Keys of previous versions are detected')
+    cache.load_data()
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messA'), [1, 'messA'], 'Records of previous versions are hit')
+        eq_(cache.exec_func(counter.increase, 'messB'), (1, 'messB'))
+    cache = FileCache(cache_file)
+    ok_(isinstance(cache.key_builder, JsonKeyBuilder))
+    cache.load_data()
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messB'), [1, 'messB'])
+
+    cache_file = f'/tmp/file_cache_{timeid}_new.txt'
+    cache = FileCache(cache_file)
+    ok_(isinstance(cache.key_builder, HashKeyBuilder), 'New logs use HashKeyBuilder')
+    with cache:
+        cache.exec_func(counter.increase, 'messA')
+    ok_(isinstance(FileCache(cache_file).key_builder, HashKeyBuilder))
+
+
+def test_cache_ttl():
+    timeid = time.time()
+    cache_file = f'/tmp/file_cache_{timeid}.txt'
+    ok_(not os.path.exists(cache_file))
+
+    counter = Counter()
+    cache = Cache()
+    cache.set_ttl(counter.increase, 0.05)
+    eq_(cache.exec_func(counter.increase, 'messA'), (1, 'messA'))
+    eq_(cache.exec_func(counter.sum, 5, 6), 11)
+    time.sleep(0.1)
+    eq_(cache.exec_func(counter.increase, 'messA'), (2, 'messA'), 'Expired value is recomputed')
+    eq_(cache.exec_func(counter.increase, 'messA'), (2, 'messA'))
+
+    counter = Counter()
+    cache = FileCache(cache_file, ttl=0.05, stale_while_revalidate=True)
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messA'), (1, 'messA'))
+        time.sleep(0.1)
+        eq_(cache.exec_func(counter.increase, 'messA'), (1, 'messA'), 'Stale value is returned')
+        cache.executor.shutdown(wait=True)
+        eq_(cache.exec_func(counter.increase, 'messA'), (2, 'messA'), 'Value is refreshed in background')
+
+    cache = FileCache(cache_file, lazy=True)
+    cache.set_ttl(counter.increase, 0.05)
+    cache.load_data()
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messA'), [2, 'messA'], 'Timestamp is persisted')
+        time.sleep(0.1)
+        eq_(cache.exec_func(counter.increase, 'messA'), (3, 'messA'))
+
+
+def test_file_cache_binary_codec():
+    timeid = time.time()
+    cache_file = f'/tmp/file_cache_{timeid}.txt'
+    ok_(not os.path.exists(cache_file))
+
+    def features(n):
+        return 'features', np.arange(n, dtype=np.float32)
+
+    cache = FileCache(cache_file, codec=BinaryCodec())
+    with cache:
+        cache.exec_func(features, 3)
+        cache.exec_func(features, 5)
+        cache.exec_func(features, 3)
+    cache = FileCache(cache_file, codec=BinaryCodec())
+    cache.load_data()
+    with cache:
+        # write a superseded record, then compact it away
+        cache.write_change(cache.get_key(features, (3,), {}))
+        cache.compact()
+
+    for lazy in [False, True]:
+        cache = FileCache(cache_file, codec=BinaryCodec(), lazy=lazy)
+        cache.load_data()
+        with cache:
+            name, array = cache.exec_func(features, 5)
+            eq_(name, 'features')
+            ok_(isinstance(array, np.ndarray), 'Types are preserved')
+            eq_(array.dtype, np.float32)
+            eq_(array.tolist(), [0, 1, 2, 3, 4])
+            eq_(cache.exec_func(features, 3)[1].tolist(), [0, 1, 2])
+            if lazy:
+                ok_(not array.flags.writeable and not array.flags.owndata, 'Array is a view of the log')
+
+
+def test_cache_delegator_batch():
+    timeid = time.time()
+    cache_file = f'/tmp/file_cache_{timeid}.txt'
+    ok_(not os.path.exists(cache_file))
+
+    cache_delegator = FileCacheDelegator(cache_file, Counter)
+    with cache_delegator:
+        eq_(cache_delegator.sum(1, 2), 3)
+        eq_(cache_delegator.exec_batch('sum', [(5, 6), (1, 2), (5, 6), (7, 8)]), [11, 3, 11, 15])
+        eq_(cache_delegator.exec_batch('increase', [('messA',), ('messB',), ('messA',)]),
+            [(1, 'messA'), (2, 'messB'), (1, 'messA')], 'Misses are computed once')
+        eq_(cache_delegator.increase('messB'), (2, 'messB'))
+        eq_(cache_delegator.exec_batch('reduce', [(5, 6), (7, 6)], executor='thread', n_workers=2), [-1, 1])
+        eq_(cache_delegator.exec_batch('reduce', [(5, 6), (9, 6)], executor='process', n_workers=2), [-1, 3])
+
+    with open(cache_file, 'r') as f:
+        eq_(len(f.readlines()), 8)
+
+
+def test_cache_stats():
+    timeid = time.time()
+    cache_file = f'/tmp/file_cache_{timeid}.txt'
+    ok_(not os.path.exists(cache_file))
+
+    counter = Counter()
+    cache = Cache(max_size=1)
+    namespace = cache.key_builder.namespace(counter.increase)
+    cache.exec_func(counter.increase, 'messA')
+    cache.exec_func(counter.increase, 'messA')
+    cache.exec_func(counter.increase, 'messB')
+    stats = cache.stats()[namespace]
+    eq_((stats['hits'], stats['misses'], stats['evictions']), (1, 2, 1))
+    eq_(stats['hit_rate'], 1 / 3)
+    cache.reset_stats()
+    eq_(cache.stats(), {})
+
+    counter = Counter()
+    cache = FileCache(cache_file)
+    with cache:
+        cache.exec_func(counter.increase, 'messA')
+        cache.exec_func(counter.increase, 'messA')
+        cache.exec_batch(counter.increase, [('messA',), ('messB',)])
+    stats = cache.stats()[namespace]
+    eq_((stats['hits'], stats['misses']), (2, 2))
+    eq_(stats['bytes_written'], os.path.getsize(cache_file))
+    ok_(stats['saved_time'] > 0)
+
+    # the counters of every cache are kept the same way
+    for cache in [Cache(), FileCache(cache_file), SqliteFileCache(f'/tmp/file_cache_{timeid}.db'),
+                  SharedMemoryCache(max_size=16, max_bytes=4096), ShardedFileCache(cache_file, n_shards=2)]:
+        counter = Counter()
+        if hasattr(cache, 'load_data'):
+            cache.load_data()
+            cache.__enter__()
+        cache.exec_func(counter.increase, 'messC')
+        cache.exec_func(counter.increase, 'messC')
+        if hasattr(cache, 'load_data'):
+            cache.__exit__(None, None, None)
+        stats = cache.stats()[namespace]
+        eq_((stats['hits'], stats['misses']), (1, 1), type(cache).__name__)
+        ok_(stats['key_time'] > 0)
+        cache.reset_stats()
+        eq_(cache.stats(), {})
+
+
+def test_sharded_file_cache():
+    timeid = time.time()
+    cache_file = f'/tmp/file_cache_{timeid}.txt'
+
+    counter = Counter()
+    cache = ShardedFileCache(cache_file, n_shards=3)
+    cache.load_data()
+    with cache:
+        eq_(cache.exec_batch(counter.sum, [(i, i) for i in range(20)]), [i * 2 for i in range(20)])
+        eq_(cache.exec_func(counter.increase, 'messA'), (1, 'messA'))
+    ok_(all(os.path.getsize(cache.get_shard_fpath(i)) > 0 for i in range(3)), 'Keys are spread over the shards')
+    eq_(cache.stats()[cache.key_builder.namespace(counter.sum)]['misses'], 20)
+
+    cache = ShardedFileCache(cache_file, n_shards=3)
+    cache.load_data()
+    key = cache.get_key(counter.increase, ('messA',), {})
+    shard = cache.shards.index(cache.get_shard(key))
+    cache.invalidate(shard)
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messA'), (2, 'messA'), 'Shard is invalidated')
+        eq_(cache.exec_batch(counter.sum, [(i, i) for i in range(20)]), [i * 2 for i in range(20)])
+    n_invalidated = sum(cache.get_shard(cache.get_key(counter.sum, (i, i), {})) is cache.shards[shard]
+                        for i in range(20))
+    eq_(cache.stats()[cache.key_builder.namespace(counter.sum)]['misses'], n_invalidated,
+        'Only keys of the invalidated shard are recomputed')
+    cache.compact(shard)
+
+
+def test_tiered_cache():
+    timeid = time.time()
+    cache_file = f'/tmp/file_cache_{timeid}.txt'
+
+    counter = Counter()
+    cache = TieredCache(cache_file, max_size=2)
+    cache.load_data()
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messA'), (1, 'messA'))
+        eq_(cache.exec_func(counter.increase, 'messB'), (2, 'messB'))
+        eq_(cache.exec_func(counter.increase, 'messC'), (3, 'messC'))
+        eq_(cache.exec_func(counter.increase, 'messC'), (3, 'messC'))
+        eq_(cache.exec_func(counter.increase, 'messA'), [1, 'messA'], 'Evicted value is read from the disk tier')
+
+    namespace = cache.key_builder.namespace(counter.increase)
+    stats = cache.stats()
+    eq_((stats['memory'][namespace]['hits'], stats['memory'][namespace]['misses']), (1, 4))
+    eq_((stats['disk'][namespace]['hits'], stats['disk'][namespace]['misses']), (1, 3))
+    eq_(len(cache.disk.data), 0, 'Disk tier is lazy')
+
+    cache.invalidate()
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messC'), (4, 'messC'))
+
+    # promoted values expire when their records expire
+    cache_file = f'/tmp/file_cache_{timeid}_2.txt'
+    counter = Counter()
+    cache = TieredCache(cache_file, max_size=2, ttl=0.2)
+    cache.load_data()
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messA'), (1, 'messA'))
+    time.sleep(0.1)
+    cache = TieredCache(cache_file, max_size=2, ttl=0.2)
+    cache.load_data()
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messA'), [1, 'messA'], 'Value is promoted')
+        time.sleep(0.15)
+        eq_(cache.exec_func(counter.increase, 'messA'), (2, 'messA'), 'Promoted value is expired')
+
+
+def test_file_cache_background_loading():
+    timeid = time.time()
+    cache_file = f'/tmp/file_cache_{timeid}.txt'
+
+    counter = Counter()
+    cache = FileCache(cache_file)
+    cache.load_data()
+    with cache:
+        cache.exec_batch(counter.sum, [(i, i) for i in range(1000)])
+        eq_(cache.exec_func(counter.increase, 'messA'), (1, 'messA'))
+    # records that aren't covered by the index
+    with open(cache_file, 'ab') as f:
+        f.write(cache.codec.encode(cache.get_key(counter.increase, ('messB',), {}), [0, 'messB'], None))
+
+    for lazy in [False, True]:
+        cache = FileCache(cache_file, lazy=lazy)
+        cache.load_data(background=True)
+        with cache:
+            eq_(cache.exec_func(counter.sum, 999, 999), 1998)
+            eq_(cache.exec_func(counter.increase, 'messA'), [1, 'messA'], 'Wait for the record of an indexed key')
+        ok_(not cache.loading)
+        eq_(len(cache.offsets), 1002)
+
+    cache = FileCache(cache_file)
+    cache.load_data(background=True)
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messC'), (2, 'messC'))
+        ok_(cache.wait_loaded())
+        ok_(cache.context_tail is not None, 'Only the records after the tail of the loader are read on exit')
+    cache = FileCache(cache_file, lazy=True)
+    cache.load_data()
+    eq_(len(cache.offsets), 1003)
+
+    cache = FileCache(cache_file)
+    cache.load_data(background=True, wait_on_miss=True)
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messB'), [0, 'messB'], 'Wait for the end of the loading')
+    ok_(cache.wait_loaded())
+
+
+def test_sqlite_file_cache():
+    timeid = time.time()
+    cache_file = f'/tmp/file_cache_{timeid}.db'
+    ok_(not os.path.exists(cache_file))
+
+    counter = Counter()
+    cache = SqliteFileCache(cache_file, flush_every=3)
+    cache.load_data()
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messA'), (1, 'messA'))
+        eq_(cache.exec_func(counter.increase, 'messA'), (1, 'messA'), 'Pending value is read back')
+        eq_(cache.exec_batch(counter.sum, [(5, 6), (1, 2), (5, 6)]), [11, 3, 11])
+        eq_(asyncio.run(cache.async_exec_func(counter.async_increase, 'messB')),
+            (2, 'messB'))
+
+    cache = SqliteFileCache(cache_file)
+    with cache:
+        eq_(cache.exec_func(counter.increase, 'messA'), (1, 'messA'), 'Tuples are preserved')
+        eq_(cache.exec_batch(counter.sum, [(1, 2), (7, 8)]), [3, 15])
+        cache.invalidate_func(counter.increase)
+        eq_(cache.exec_func(counter.increase, 'messA'), (3, 'messA'))
+        eq_(cache.exec_func(counter.sum, 5, 6), 11)
+    eq_(cache.stats()[cache.key_builder.namespace(counter.sum)]['misses'], 1)
+    cache.compact()
+
+    # tables created and dropped by another connection
+    cache, peer = SqliteFileCache(cache_file), SqliteFileCache(cache_file)
+    with cache, peer:
+        eq_(cache.exec_func(counter.reduce, 5, 6), -1)
+        eq_(peer.exec_func(counter.reduce, 5, 6), -1)
+        eq_(peer.stats()[peer.key_builder.namespace(counter.reduce)]['misses'], 0, 'New table is read')
+        peer.invalidate_func(counter.reduce)
+        eq_(cache.exec_func(counter.reduce, 9, 6), 3, 'Dropped table is a miss')
+        eq_(cache.exec_func(counter.reduce, 9, 6), 3)
+
+    cache_delegator = FileCacheDelegator(cache_file, Counter, backend='sqlite')
+    with cache_delegator:
+        eq_(cache_delegator.exec_batch('reduce', [(5, 6), (9, 6)], executor='process', n_workers=2), [-1, 3])
+        cache_delegator.invalidate_func('reduce')
+        eq_(cache_delegator.reduce(5, 6), -1)
+    eq_(cache_delegator.stats()['reduce']['misses'], 3, 'Results are recomputed after invalidating the method')
+    cache_delegator.invalidate()
+
+
+def test_shared_memory_cache():
+    counter = Counter()
+    cache = SharedMemoryCache(max_size=3, max_bytes=4096)
+    eq_(cache.exec_func(counter.increase, 'messA'), (1, 'messA'))
+    eq_(cache.exec_func(counter.increase, 'messA'), (1, 'messA'), 'Types are preserved')
+    array = cache.exec_func(np.arange, 10)
+    ok_(np.array_equal(cache.exec_func(np.arange, 10), array))
+    ok_(not cache.exec_func(np.arange, 10).flags.writeable, 'Arrays are read-only views of the map')
+
+    def worker():
+        hit = cache.exec_func(counter.increase, 'messA') == (1, 'messA')
+        cache.exec_func(counter.increase, 'messB')
+        os._exit(0 if hit else 1)
+
+    process = multiprocessing.get_context('fork').Process(target=worker)
+    process.start()
+    process.join()
+    eq_(process.exitcode, 0, 'Worker reads values of its parent')
+    eq_(cache.exec_func(counter.increase, 'messB'), (2, 'messB'), 'Parent reads values of its worker')
+    eq_(len(cache), 3)
+
+    eq_(cache.exec_func(counter.increase, 'messC'), (2, 'messC'))
+    eq_(cache.exec_func(counter.increase, 'messC'), (3, 'messC'), 'Values are not cached once the cache is full')
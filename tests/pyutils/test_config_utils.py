@@ -1,10 +1,11 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
-import os, uuid
+import os, pickle, time, uuid
 
 from nose.tools import ok_, eq_
 
-from pyutils.config_utils import load_config, write_config, StringConf, Configuration, ListConf
+from pyutils.config_utils import load_config, write_config, StringConf, Configuration, ListConf, ConfigWatcher, \
+    RemoteOSPath, compose_config, get_snapshot_fpath, merge_trees
 
 
 def test_io():
@@ -225,3 +226,393 @@ data:
     config = load_config(config_file)
     ok_(list(config.data.gold.items()), [('monthly_expense', 'expense_sheets.csv'), ('monthly_expense_path', '/home/peter/expense_sheets.csv')])
     ok_(list(config.data.gold), ['monthly_expense', 'monthly_expense_path'])
+
+
+def test_lazy_ops():
+    file_id = str(uuid.uuid4())
+    config_file = f'/tmp/config_file_{file_id}.txt'
+    ok_(not os.path.exists(config_file))
+
+    with open(config_file, 'w') as f:
+        f.write(f'''
+logs:
+    __workdir__: /home/peter
+    expense: expense_sheets.csv
+data:
+    __workdir__: '/data'
+    gold:
+        monthly_expense: '@logs.expense'
+        monthly_expense_path: '@@logs.expense'
+    checklists:
+        - '@logs.expense'
+        - '@#expense_sheets.csv'
+    people:
+        - name: peter
+          expense: '@logs.expense'
+broken:
+    expense: '@logs.missing'
+''')
+
+    config = load_config(config_file, lazy=True)
+    eq_(config.data.gold.monthly_expense_path, '/home/peter/expense_sheets.csv')
+    ok_(isinstance(config.data.gold.monthly_expense, StringConf))
+    eq_(config.get_conf('data.gold.monthly_expense').as_path(), '/home/peter/expense_sheets.csv')
+    eq_(config.data.checklists.to_list(), ['expense_sheets.csv', '/data/expense_sheets.csv'])
+    eq_(config.data.people[0].expense, 'expense_sheets.csv')
+
+    del config.broken
+    eq_(config.to_dict(), {
+        'logs': {'expense': 'expense_sheets.csv'},
+        'data': {
+            'gold': {
+                'monthly_expense': 'expense_sheets.csv',
+                'monthly_expense_path': '/home/peter/expense_sheets.csv',
+            },
+            'checklists': ['expense_sheets.csv', '/data/expense_sheets.csv'],
+            'people': [{'name': 'peter', 'expense': 'expense_sheets.csv'}],
+        }
+    }, 'Unused broken references are never resolved')
+
+
+def test_ref_graph_ops():
+    config = Configuration({
+        'paths': {
+            'report': '@paths.summary',
+            'summary': '@@logs.expense',
+            'backup': '@alias.expense',
+        },
+        'alias': '@logs',
+        'logs': {
+            '__workdir__': '/home/peter',
+            'expense': 'expense_sheets.csv',
+        },
+    })
+    eq_(config.paths.report, '/home/peter/expense_sheets.csv', 'Reference to a reference declared later')
+    eq_(config.paths.backup, 'expense_sheets.csv', 'Reference through a reference to a configuration')
+
+    for lazy in [False, True]:
+        config = Configuration({'e': '@b', 'f': '@e.x', 'b': {'x': '@g'}, 'g': 'G'}, lazy=lazy)
+        eq_(config.f, 'G', 'Reference to a reference reached through another reference')
+
+    for lazy, chain in [(False, 'a.b -> c -> d -> a.b'), (True, 'c -> d -> a.b -> c')]:
+        try:
+            config = Configuration({'a': {'b': '@c'}, 'c': '@d', 'd': '@a.b'}, lazy=lazy)
+            config.to_dict()
+            ok_(False, 'Cyclic references must be reported')
+        except ValueError as e:
+            eq_(str(e), 'Cyclic references: ' + chain)
+
+
+def test_snapshot_ops():
+    file_id = str(uuid.uuid4())
+    config_file = f'/tmp/config_file_{file_id}.txt'
+    snapshot_dir = f'/tmp/config_snapshots_{file_id}'
+    ok_(not os.path.exists(config_file))
+
+    with open(config_file, 'w') as f:
+        f.write(f'''
+logs:
+    __workdir__: /home/peter
+    expense: expense_sheets.csv
+data:
+    gold: '@@logs.expense'
+''')
+
+    config = load_config(config_file, snapshot_dir=snapshot_dir)
+    snapshot_file = get_snapshot_fpath(config_file, snapshot_dir)
+    ok_(os.path.exists(snapshot_file))
+    eq_(config.data.gold, '/home/peter/expense_sheets.csv')
+    eq_(list(config), ['logs', 'data'], 'Order is preserved')
+
+    # the snapshot is used while the file isn't modified
+    mtime = os.path.getmtime(snapshot_file)
+    eq_(load_config(config_file, snapshot_dir=snapshot_dir).to_dict(), config.to_dict())
+    eq_(os.path.getmtime(snapshot_file), mtime)
+
+    with open(config_file, 'a') as f:
+        f.write('    silver: 5\n')
+    config = load_config(config_file, snapshot_dir=snapshot_dir)
+    eq_(config.data.silver, 5, 'Modified file is parsed again')
+    eq_(load_config(config_file, snapshot_dir=snapshot_dir).data.silver, 5)
+
+    # unreadable snapshots are replaced
+    for content in [b'garbage', pickle.dumps((1, 2, 3, 4, 5))[:-3]]:
+        with open(snapshot_file, 'wb') as f:
+            f.write(content)
+        eq_(load_config(config_file, snapshot_dir=snapshot_dir).data.silver, 5)
+        eq_(load_config(config_file, snapshot_dir=snapshot_dir).data.silver, 5)
+
+
+def test_watcher_ops():
+    file_id = str(uuid.uuid4())
+    config_file = f'/tmp/config_file_{file_id}.txt'
+    ok_(not os.path.exists(config_file))
+
+    content = '''
+logs:
+    __workdir__: /home/peter
+    expense: expense_sheets.csv
+data:
+    gold: '@@logs.expense'
+    silver:
+        weight: 5
+model:
+    lr: 0.1
+    layers: 2
+'''
+    with open(config_file, 'w') as f:
+        f.write(content)
+
+    config = load_config(config_file)
+    silver = config.data.silver
+    watcher = ConfigWatcher(config, config_file)
+    calls = []
+    watcher.on_change('model', calls.append)
+    watcher.on_change('data.gold', calls.append)
+    eq_(watcher.check(), [], 'File is not modified')
+
+    with open(config_file, 'w') as f:
+        f.write(content.replace('/home/peter', '/home/mary').replace('lr: 0.1', 'lr: 0.01').replace('layers: 2', ''))
+    eq_(watcher.check(), ['logs', 'data.gold', 'model.lr', 'model.layers'], 'Subtrees with another workdir are replaced')
+    eq_(calls, [['model.lr', 'model.layers'], ['data.gold']])
+    eq_(config.data.gold, '/home/mary/expense_sheets.csv')
+    eq_(config.model.lr, 0.01)
+    ok_('layers' not in config.model)
+    ok_(config.data.silver is silver, 'Unchanged subtrees are kept')
+    eq_(config.to_raw_dict()['model']['lr'], 0.01)
+
+    with open(config_file, 'w') as f:
+        f.write('model: [')
+    eq_(watcher.check(), [])
+    ok_(watcher.error is not None, 'Invalid file is ignored')
+    eq_(config.model.lr, 0.01)
+    watcher.start().stop()
+
+    with open(config_file, 'w') as f:
+        f.write('logging:\n  loggers:\n    app.module:\n      level: INFO\n')
+    config = load_config(config_file)
+    watcher = ConfigWatcher(config, config_file, interval=0.01)
+    with open(config_file, 'w') as f:
+        f.write('logging:\n  loggers:\n    app.module:\n      level: DEBUG\n')
+    eq_(watcher.check(), ['logging.loggers.app.module.level'], 'Keys may contain dots')
+    eq_(config.logging.loggers['app.module'].level, 'DEBUG')
+
+    def fail(changes):
+        raise RuntimeError(changes)
+
+    watcher.on_change('', fail).start()
+    try:
+        with open(config_file, 'w') as f:
+            f.write('logging:\n  loggers:\n    app.module:\n      level: WARNING\n')
+        while not isinstance(watcher.error, RuntimeError):
+            time.sleep(0.01)
+        eq_(config.logging.loggers['app.module'].level, 'WARNING')
+        with open(config_file, 'w') as f:
+            f.write('logging:\n  loggers:\n    app.module:\n      level: ERROR\n')
+        while config.logging.loggers['app.module'].level != 'ERROR':
+            time.sleep(0.01)
+        ok_(watcher.thread.is_alive(), 'Errors of callbacks do not stop the polling')
+    finally:
+        watcher.stop()
+
+
+def test_path_ops():
+    path = StringConf('Downloads/../Documents', '/home/ubuntu')
+    eq_(path.as_path(), '/home/ubuntu/Documents')
+    ok_(path.as_path() is path.as_path(), 'Path is resolved once')
+    eq_(StringConf('/data', '/home/ubuntu').as_path(), '/data')
+    eq_(StringConf('data/x', 'hdfs://localhost:9000/user').as_path(), 'hdfs://localhost:9000/user/data/x')
+    eq_(RemoteOSPath.resolve('hdfs://localhost:9000/user', 'gs://bucket/x'), 'gs://bucket/x')
+
+    # relative paths depend on the working directory
+    cwd = os.getcwd()
+    path = StringConf('x', 'relative')
+    try:
+        os.chdir('/tmp')
+        eq_(path.as_path(), '/tmp/relative/x')
+        os.chdir('/')
+        eq_(path.as_path(), '/relative/x')
+    finally:
+        os.chdir(cwd)
+
+
+def test_compiled_key_ops():
+    config = Configuration({
+        'logs': {'__workdir__': '/home/peter', 'expense': 'expense_sheets.csv'},
+        'data': {'gold': '@@logs.expense'},
+    })
+    expense = config.compile_key('logs.expense')
+    eq_(expense(), 'expense_sheets.csv')
+    eq_(config.get_conf('data.gold'), '/home/peter/expense_sheets.csv')
+    ok_(config.get_conf('data.gold') is config.data.gold)
+
+    config.logs.set_conf('expense', 'income.csv')
+    eq_(expense(), 'income.csv', 'Accessors see modifications of children')
+    config.set_conf('data.gold', 'gold.csv')
+    eq_(config.get_conf('data.gold'), 'gold.csv', 'Index is updated by set_conf')
+    del config.data['gold']
+    try:
+        config.get_conf('data.gold')
+        ok_(False, 'Deleted key must not be indexed')
+    except KeyError:
+        pass
+
+    eq_(config.get_conf('logs.expense'), 'income.csv')
+    index = config._Configuration__index
+    Configuration({'a': '@b', 'b': 1}).set_conf('c', 2)
+    eq_(config.get_conf('logs.expense'), 'income.csv')
+    ok_(config._Configuration__index is index, 'Index is kept when other configurations are created or modified')
+
+    config.set_conf('extra', {'rate': 1})
+    rate = config.compile_key('extra.rate')
+    eq_(rate(), 1)
+    config.extra.set_conf('rate', 2)
+    eq_(rate(), 2, 'Assigned configurations are part of the tree')
+
+    config = Configuration({'a': {'b': {'c': {'d': 1}}}})
+    depth = config.a.b.compile_key('c.d')
+    config.set_conf('a.b.c.d', 2)
+    eq_(depth(), 2, 'Nested configurations share the version of their root')
+    eq_(config.a.b.get_conf('c.d'), 2)
+    config.a.b.c.set_conf('d', 3)
+    eq_(depth(), 3)
+    eq_(config.a.b.get_conf('c.d'), 3)
+
+
+def test_compose_ops():
+    file_id = str(uuid.uuid4())
+    config_dir = f'/tmp/config_dir_{file_id}'
+    os.makedirs(config_dir)
+
+    with open(f'{config_dir}/common.yml', 'w') as f:
+        f.write('''
+logs:
+    expense: expense_sheets.csv
+model:
+    lr: 0.1
+    layers: [64, 64]
+''')
+    with open(f'{config_dir}/base.yml', 'w') as f:
+        f.write('''
+__include__: common.yml
+data:
+    gold: '@@logs.expense'
+model:
+    dropout: 0.5
+''')
+    with open(f'{config_dir}/prod.yml', 'w') as f:
+        f.write('''
+model:
+    lr: 0.01
+    layers: [128]
+''')
+
+    config = compose_config([f'{config_dir}/base.yml', f'{config_dir}/prod.yml', f'{config_dir}/host.yml'],
+                            env_prefix='APP__', environ={'APP__MODEL__DROPOUT': '0.2', 'APP__NAME': 'svc', 'HOME': '/'},
+                            ignore_missing=True)
+    eq_(config.to_dict(), {
+        'logs': {'expense': 'expense_sheets.csv'},
+        'model': {'lr': 0.01, 'layers': [128], 'dropout': 0.2},
+        'data': {'gold': f'{config_dir}/expense_sheets.csv'},
+        'name': 'svc',
+    })
+    eq_(config.get_source('logs.expense'), f'{config_dir}/common.yml')
+    eq_(config.get_source('model.lr'), f'{config_dir}/prod.yml')
+    eq_(config.model.get_source('dropout'), 'env:APP__MODEL__DROPOUT')
+    eq_(config.get_source('model'), 'env:APP__MODEL__DROPOUT')
+    eq_(config.get_source('missing'), None)
+
+    with open(f'{config_dir}/nested.yml', 'w') as f:
+        f.write('a: {b: {c: 1, d: 2}}\n')
+    with open(f'{config_dir}/nested_prod.yml', 'w') as f:
+        f.write('a: {b: {c: 3}}\n')
+    for lazy in [False, True]:
+        config = compose_config([f'{config_dir}/nested.yml', f'{config_dir}/nested_prod.yml'], lazy=lazy)
+        eq_(config.a.b.get_source('c'), f'{config_dir}/nested_prod.yml')
+        eq_(config.a.b.get_source('d'), f'{config_dir}/nested.yml')
+        eq_(config.get_source('a.b.c'), f'{config_dir}/nested_prod.yml')
+
+    base = {'logs': {'expense': 'a.csv'}, 'model': {'lr': 0.1}}
+    merged = merge_trees(base, {'model': {'lr': 0.01}})
+    eq_(merged, {'logs': {'expense': 'a.csv'}, 'model': {'lr': 0.01}})
+    ok_(merged['logs'] is base['logs'], 'Unchanged subtrees are shared')
+    eq_(base['model']['lr'], 0.1)
+
+    with open(f'{config_dir}/common.yml', 'a') as f:
+        f.write('__include__: base.yml\n')
+    try:
+        compose_config([f'{config_dir}/base.yml'])
+        ok_(False, 'Cyclic includes must be reported')
+    except ValueError as e:
+        eq_(str(e), f'Cyclic includes: {config_dir}/base.yml -> {config_dir}/common.yml -> {config_dir}/base.yml')
+
+
+def test_freeze_ops():
+    raw = {
+        'logs': {'__workdir__': '/home/peter', 'expense': 'expense_sheets.csv'},
+        'data': {'gold': '@@logs.expense', 'checklists': ['@logs.expense', 'x.csv'], 'sizes': [1, 2]},
+        'people': [{'name': 'peter'}],
+    }
+    frozen = Configuration(raw, '/data').freeze()
+    eq_(frozen.logs.expense.as_path(), '/home/peter/expense_sheets.csv')
+    eq_(frozen.data.gold, '/home/peter/expense_sheets.csv')
+    eq_(frozen.data.checklists.to_list(), ['expense_sheets.csv', 'x.csv'])
+    eq_(frozen.data.checklists[1].as_path(), '/data/x.csv')
+    eq_(frozen.get_conf('people')[0].name, 'peter')
+    ok_(not hasattr(frozen, '__dict__') and not hasattr(frozen.data.gold, '__dict__'))
+
+    eq_(frozen, Configuration(raw, '/data', lazy=True).freeze())
+    eq_(hash(frozen), hash(Configuration(raw, '/data').freeze()))
+    ok_(frozen != Configuration(raw, '/tmp').freeze())
+    eq_({frozen: 1}[Configuration(raw, '/data').freeze()], 1)
+    eq_(frozen.__cache_key__(), Configuration(raw, '/data', lazy=True).freeze().__cache_key__(),
+        'Digest is the key of the configuration in caches')
+    ok_(frozen.__cache_key__() != Configuration(raw, '/tmp').freeze().__cache_key__())
+    ok_(frozen.__cache_key__() != Configuration(dict(raw, people=[{'name': 'mary'}]), '/data').freeze().__cache_key__())
+
+    copied = pickle.loads(pickle.dumps(frozen))
+    eq_(copied, frozen)
+    eq_(copied.__cache_key__(), frozen.__cache_key__())
+    eq_(copied.data.checklists[1].as_path(), '/data/x.csv')
+    eq_(copied.to_dict(), Configuration(raw, '/data').to_dict())
+
+    try:
+        frozen.logs = 5
+        ok_(False, 'Frozen configuration must be read-only')
+    except TypeError:
+        pass
+
+
+def test_cached_to_dict_ops():
+    raw = {
+        'logs': {'expense': 'expense_sheets.csv', 'level': 'INFO'},
+        'data': {'gold': '@logs', 'people': [{'name': 'peter'}], 'sizes': [1, 2]},
+        'meta': {'version': 1},
+    }
+    config = Configuration(raw, '/data')
+    dict_object = config.to_cached_dict()
+    ok_(config.to_cached_dict() is dict_object)
+    meta = config.meta.to_cached_dict()
+
+    copied = config.to_dict()
+    copied['logs']['level'] = 'ERROR'
+    copied['data']['sizes'].append(3)
+    eq_(config.to_dict(), dict_object, 'Copies can be modified')
+    eq_(dict_object['logs']['level'], 'INFO')
+
+    config.set_conf('logs.level', 'DEBUG')
+    eq_(config.to_dict()['logs']['level'], 'DEBUG')
+    # the configuration referencing the modified one is invalidated, the untouched one is not
+    eq_(config.data.to_dict()['gold']['level'], 'DEBUG')
+    ok_(config.meta.to_cached_dict() is meta)
+
+    config.data.people[0].set_conf('name', 'john')
+    eq_(config.to_dict()['data']['people'], [{'name': 'john'}])
+    config.data.sizes[0] = 3
+    eq_(config.to_dict()['data']['sizes'], [3, 2])
+    del config.meta['version']
+    eq_(config.to_dict()['meta'], {})
+    config.set_conf('extra.x', 1)
+    eq_(config.to_dict()['extra'], {'x': 1})
+    eq_(config.to_dict(including_workdir=True)['__workdir__'], '/data')
+    ok_('__workdir__' not in config.to_dict())